@@ -7,6 +7,7 @@ from keras.callbacks import LearningRateScheduler
 from keras.preprocessing.image import ImageDataGenerator
 
 import utils
+import encoding
 
 
 def _build_model(x_shape, relu_max, encode_fn,
@@ -148,7 +149,20 @@ class AutoEncoder(object):
         vis_fn(ed_recon, rows, cols,
                os.path.join(self.folder, 'test_encoder_decoder_recon.png'))
 
-    def encode(self, dataset_cls):
+    def encode(self, dataset_cls, h5_path=None, chunk_size=1000):
+        """Encode the dataset; with h5_path, stream codes chunk by chunk.
+
+        With h5_path the codes go to h5_path (resumable, see
+        encoding.encode_to_h5) and a lazy dataset on that file is returned.
+        """
+        if h5_path:
+            encoding.encode_to_h5(
+                self.encoder.predict,
+                self.dataset.train_xs, self.dataset.train_ys,
+                self.dataset.test_xs, self.dataset.test_ys,
+                h5_path, chunk_size)
+            return dataset_cls.load_from_h5(h5_path, lazy=True)
+
         encoded_train_xs = self.encoder.predict(self.dataset.train_xs)
         encoded_test_xs = self.encoder.predict(self.dataset.test_xs)
         print 'in encode: min: %f, max: %f' \
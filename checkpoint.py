@@ -0,0 +1,266 @@
+"""Atomic h5 checkpoints of numpy arrays, scalars and the numpy RNG state.
+
+A checkpoint is written to path + '.tmp', synced to disk and renamed over
+path, so path always holds either the previous or the new checkpoint, even
+if the job is killed while writing.
+
+Only the numpy RNG (np.random) is saved. The streams of TF random ops
+cannot be read or set in TF 1.x: after a resume they restart from the
+graph seed, so sampling ops draw different numbers than an uninterrupted
+run would. Everything else (params, chains, schedule position, data
+order) resumes exactly.
+"""
+import os
+import threading
+import Queue
+import h5py
+import numpy as np
+
+
+def _save_rng_state(hf, state):
+    name, keys, pos, has_gauss, cached_gaussian = state
+    group = hf.create_group('np_random_state')
+    group.create_dataset('keys', data=keys)
+    group.attrs['name'] = name
+    group.attrs['pos'] = pos
+    group.attrs['has_gauss'] = has_gauss
+    group.attrs['cached_gaussian'] = cached_gaussian
+
+
+def _load_rng_state(hf):
+    group = hf['np_random_state']
+    np.random.set_state((str(group.attrs['name']), np.array(group['keys']),
+                         int(group.attrs['pos']), int(group.attrs['has_gauss']),
+                         float(group.attrs['cached_gaussian'])))
+
+
+def save(path, arrays, attrs=None, rng_state=True):
+    """Atomically write a checkpoint.
+
+    arrays: dict of name -> numpy array, '/' in names creates h5 groups
+    attrs: dict of name -> scalar or string, e.g. epoch
+    rng_state: True to also save np.random.get_state(), or a state
+               captured earlier by np.random.get_state()
+    """
+    tmp_path = path + '.tmp'
+    with h5py.File(tmp_path, 'w') as hf:
+        for name, val in arrays.items():
+            hf.create_dataset(name, data=val)
+        for name, val in (attrs or {}).items():
+            hf.attrs[name] = val
+        if rng_state is True:
+            rng_state = np.random.get_state()
+        if rng_state:
+            _save_rng_state(hf, rng_state)
+    with open(tmp_path, 'rb+') as f:
+        os.fsync(f.fileno())
+    os.rename(tmp_path, path)
+    # make the rename itself durable
+    dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def load(path):
+    """Read a checkpoint written by save(), see restore_rng for np.random.
+
+    return: dict of arrays, dict of attrs
+    """
+    arrays = {}
+    with h5py.File(path, 'r') as hf:
+        def collect(name, node):
+            if isinstance(node, h5py.Dataset) \
+               and not name.startswith('np_random_state'):
+                arrays[name] = np.array(node)
+        hf.visititems(collect)
+        attrs = dict(hf.attrs.items())
+    return arrays, attrs
+
+
+def restore_rng(path):
+    """Set np.random to the state saved in the checkpoint, if there is one.
+
+    Call it last, after building the graph and keras models, which draw
+    their initial values from np.random.
+    """
+    with h5py.File(path, 'r') as hf:
+        if 'np_random_state' in hf:
+            _load_rng_state(hf)
+
+
+def read_attrs(path):
+    """Return the attrs of a checkpoint without loading its arrays."""
+    with h5py.File(path, 'r') as hf:
+        return dict(hf.attrs.items())
+
+
+class AsyncWriter(object):
+    """Write checkpoints with save() on a background thread.
+
+    At most one checkpoint waits while another is being written, so write()
+    only blocks if checkpoints are requested faster than the disk takes
+    them. An error in the writer thread is raised by the next call.
+    """
+    def __init__(self):
+        self._queue = Queue.Queue(maxsize=1)
+        self._error = None
+        self._thread = threading.Thread(target=self._run)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def _run(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                save(*item)
+                print '\tCheckpoint saved to:', item[0]
+            except Exception as e:
+                self._error = e
+            finally:
+                self._queue.task_done()
+
+    def _raise_error(self):
+        if self._error is not None:
+            error, self._error = self._error, None
+            raise error
+
+    def write(self, path, arrays, attrs=None):
+        """Queue a checkpoint, the np rng state is captured here."""
+        self._raise_error()
+        self._queue.put((path, arrays, attrs, np.random.get_state()))
+
+    def wait(self):
+        """Block until all queued checkpoints are on disk."""
+        self._queue.join()
+        self._raise_error()
+
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+        self._raise_error()
+
+
+class TrainingCheckpoint(object):
+    """Resumable state of a training run in one checkpoint file.
+
+    Holds the values of variables (params, persistent chains, optimizer
+    slots), the epoch, the stage (index into a list of TrainConfig), the
+    training log and the np rng state. Values are read from the session on
+    the calling thread, the h5 file is written by an AsyncWriter.
+
+    variables: dict of key -> Variable. The keys name the values in the
+               file, so they must not depend on the order the graph is
+               built in (auto names like Variable_3 do), e.g.
+               'rbm/weights' or 'rbm/pcd_chain_stage2'.
+    """
+    def __init__(self, sess, path, variables):
+        self.sess = sess
+        self.path = path
+        self.variables = dict(('variables/' + key, var)
+                              for key, var in variables.items())
+        self.writer = AsyncWriter()
+
+    def exists(self):
+        return os.path.exists(self.path)
+
+    def progress(self):
+        """Return stage, epoch of the checkpoint on disk."""
+        attrs = read_attrs(self.path)
+        return int(attrs['stage']), int(attrs['epoch'])
+
+    def save(self, stage, epoch, log):
+        names = sorted(self.variables)
+        vals = self.sess.run([self.variables[name] for name in names])
+        arrays = dict(zip(names, vals))
+        arrays['log'] = np.array(log, dtype='S')
+        self.writer.write(self.path, arrays, {'stage': stage, 'epoch': epoch})
+
+    def restore(self):
+        """Load variables and np rng, return: stage, epoch, log.
+
+        Call it once everything that draws from np.random is built.
+        """
+        arrays, attrs = load(self.path)
+        for name, var in self.variables.items():
+            var.load(arrays[name], self.sess)
+        restore_rng(self.path)
+        print 'Resume from %s at stage %d, epoch %d' \
+            % (self.path, attrs['stage'], attrs['epoch'])
+        log = [str(line) for line in arrays['log']]
+        return int(attrs['stage']), int(attrs['epoch']), log
+
+    def close(self):
+        """Wait for the last checkpoint and stop the writer thread."""
+        self.writer.close()
+
+
+def optimizer_slots(optimizer, variables, prefix='optimizer'):
+    """Slot variables (e.g. momentum) of optimizer for variables.
+
+    variables: dict of key -> Variable, as for TrainingCheckpoint
+    return: dict of prefix/key/slot_name -> slot Variable
+    """
+    slots = {}
+    for name in optimizer.get_slot_names():
+        for key, var in variables.items():
+            slot = optimizer.get_slot(var, name)
+            if slot is not None:
+                slots['%s/%s/%s' % (prefix, key, name)] = slot
+    return slots
+
+
+# test =================
+def restore_in_fresh_graph(path):
+    """Save variables of one graph, restore them into a fresh graph.
+
+    The fresh graph builds the variables in another order, so their auto
+    names differ, only the checkpoint keys match.
+    """
+    import tensorflow as tf
+
+    np.random.seed(666)
+    with tf.Graph().as_default():
+        tf.Variable(0.0) # shifts the auto names of the variables below
+        chain = tf.Variable(np.random.uniform(0, 1, (4, 3)), dtype=tf.float32)
+        weights = tf.Variable(np.random.normal(0, 1, (3, 2)), dtype=tf.float32)
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            ckpt = TrainingCheckpoint(
+                sess, path, {'rbm/weights': weights, 'rbm/pcd_chain_stage1': chain})
+            ckpt.save(1, 5, ['Epoch 5, Train Loss: 0.5'])
+            ckpt.close()
+            saved_weights, saved_chain = sess.run([weights, chain])
+    next_rand = np.random.uniform()
+
+    np.random.seed(1)
+    with tf.Graph().as_default():
+        weights = tf.Variable(tf.zeros([3, 2]))
+        chain = tf.Variable(tf.zeros([4, 3]))
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            ckpt = TrainingCheckpoint(
+                sess, path, {'rbm/pcd_chain_stage1': chain, 'rbm/weights': weights})
+            assert ckpt.progress() == (1, 5)
+            stage, epoch, log = ckpt.restore()
+            ckpt.close()
+            restored_weights, restored_chain = sess.run([weights, chain])
+    assert (stage, epoch, log) == (1, 5, ['Epoch 5, Train Loss: 0.5'])
+    assert np.array_equal(restored_weights, saved_weights)
+    assert np.array_equal(restored_chain, saved_chain)
+    assert np.random.uniform() == next_rand
+    print 'restore in fresh graph: ok'
+
+
+if __name__ == '__main__':
+    import tempfile
+    import shutil
+
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        restore_in_fresh_graph(os.path.join(tmp_dir, 'checkpoint.h5'))
+    finally:
+        shutil.rmtree(tmp_dir)
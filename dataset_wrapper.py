@@ -1,5 +1,8 @@
 """Wrapper classes for original and encoded datasets."""
 from keras.datasets import mnist, cifar10
+import threading
+import Queue
+import time
 import numpy as np
 import matplotlib.pyplot as plt
 import h5py
@@ -7,20 +10,107 @@ import utils
 import stl_dataset
 
 
+# rows of an H5Array held in memory at once while iterating minibatches
+WINDOW_BYTES = 256 * 2**20
+# read granularity of contiguous (unchunked) h5 datasets
+CONTIGUOUS_CHUNK_BYTES = 4 * 2**20
+
+
+class H5Array(object):
+    """Lazy float32 view of an h5 dataset, read chunk by chunk on access.
+
+    Supports len, shape, slices and integer index arrays on the first axis,
+    which covers x_shape, get_subset and minibatch gathering.
+    """
+    def __init__(self, dataset):
+        self.dataset = dataset
+
+    @property
+    def shape(self):
+        return self.dataset.shape
+
+    @property
+    def dtype(self):
+        return np.dtype(np.float32)
+
+    @property
+    def row_bytes(self):
+        return int(np.prod(self.shape[1:])) * self.dataset.dtype.itemsize
+
+    @property
+    def chunk_len(self):
+        """Rows per h5 chunk, about 4MB of rows for contiguous datasets."""
+        if self.dataset.chunks:
+            return self.dataset.chunks[0]
+        return max(1, CONTIGUOUS_CHUNK_BYTES // self.row_bytes)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def __getitem__(self, key):
+        if isinstance(key, (slice, int, np.integer)):
+            return np.asarray(self.dataset[key], dtype=np.float32)
+        idx = np.asarray(key)
+        if idx.dtype == np.bool_:
+            idx = np.where(idx)[0]
+        out = np.empty((len(idx),) + self.shape[1:], np.float32)
+        return self.read_into(idx, out)
+
+    def read_chunks(self, chunks):
+        """Rows of the given chunk ids, in that order, one read per chunk."""
+        chunk_len = self.chunk_len
+        return np.concatenate(
+            [np.asarray(self.dataset[c * chunk_len:(c+1) * chunk_len],
+                        dtype=np.float32) for c in chunks])
+
+    def read_into(self, idx, out):
+        """Gather rows idx (any order) into out, reading every touched chunk
+        once, meant for one-off subsets, see MinibatchIterator for epochs.
+        """
+        order = np.argsort(idx, kind='mergesort')
+        sorted_idx = idx[order]
+        chunk_len = self.chunk_len
+        start = 0
+        while start < len(sorted_idx):
+            chunk_begin = sorted_idx[start] // chunk_len * chunk_len
+            stop = np.searchsorted(sorted_idx, chunk_begin + chunk_len)
+            block = self.dataset[chunk_begin:chunk_begin + chunk_len]
+            out[order[start:stop]] = block[sorted_idx[start:stop] - chunk_begin]
+            start = stop
+        return out
+
+
 class DatasetWrapper(object):
     def __init__(self, train_xs, train_ys, test_xs, test_ys):
         """DO NOT do any normalization in this function"""
-        self.train_xs = train_xs.astype(np.float32)
+        self.train_xs = _as_float32(train_xs)
         self.train_ys = train_ys
-        self.test_xs = test_xs.astype(np.float32)
+        self.test_xs = _as_float32(test_xs)
         self.test_ys = test_ys
 
     @property
     def x_shape(self):
         return self.train_xs.shape[1:]
 
+    @property
+    def is_lazy(self):
+        return isinstance(self.train_xs, H5Array)
+
     @classmethod
-    def load_from_h5(cls, h5_path):
+    def load_from_h5(cls, h5_path, lazy=False):
+        """Load dataset from h5, lazy=True keeps xs on disk as H5Array.
+
+        In lazy mode the h5 file stays open for the life of the dataset.
+        """
+        if lazy:
+            hf = h5py.File(h5_path, 'r')
+            train_xs = H5Array(hf['train_xs'])
+            test_xs = H5Array(hf['test_xs'])
+            train_ys = np.array(hf.get('train_ys'))
+            test_ys = np.array(hf.get('test_ys'))
+            print 'Dataset opened (lazy) from %s' % h5_path
+            return cls(train_xs, train_ys, test_xs, test_ys)
+
         with h5py.File(h5_path, 'r') as hf:
             train_xs = np.array(hf.get('train_xs'))
             train_ys = np.array(hf.get('train_ys'))
@@ -42,6 +132,7 @@ class DatasetWrapper(object):
         print 'Dataset written to %s' % h5_path
 
     def reshape(self, new_shape):
+        assert not self.is_lazy, 'Cannot reshape a lazy dataset.'
         batch_size = self.train_xs.shape[0]
         self.train_xs = self.train_xs.reshape((batch_size,) + new_shape)
         batch_size = self.test_xs.shape[0]
@@ -77,6 +168,149 @@ class DatasetWrapper(object):
             ys = ys[loc]
         return xs, ys
 
+    def iterate_batches(self, subset, batch_size, shuffle=True):
+        """Yield minibatches of xs without reordering the data itself.
+
+        See MinibatchIterator, each batch is valid until the next one.
+        """
+        xs = self.train_xs if subset == 'train' else self.test_xs
+        return iter(MinibatchIterator(xs, batch_size, shuffle))
+
+
+class MinibatchIterator(object):
+    """Iterate over minibatches of xs through a shuffled index.
+
+    xs is never reordered: every epoch permutes an index and batches are
+    gathered into reused preallocated buffers. Lazy H5Array xs are read
+    once per epoch, a window of whole chunks (up to WINDOW_BYTES, chunks
+    in random order) at a time, and the window is shuffled in memory; rows
+    left over at the end of a window are carried into the next one. With
+    prefetch=n (True means 1) a background
+    thread stages up to n upcoming batches in a queue while the current one
+    is being used; queue_stats() reports how full the queue was.
+    A yielded batch is only valid until the next batch is requested.
+    """
+    def __init__(self, xs, batch_size, shuffle=True, prefetch=0):
+        self.xs = xs
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.prefetch = int(prefetch)
+        # one batch in use, prefetch in the queue and one being gathered
+        num_buffers = self.prefetch + 2 if self.prefetch else 1
+        self._buffers = [np.empty((batch_size,) + tuple(xs.shape[1:]), xs.dtype)
+                         for _ in range(num_buffers)]
+        self._reset_stats()
+
+    def __len__(self):
+        return int(np.ceil(len(self.xs) / float(self.batch_size)))
+
+    def _index(self, num):
+        if not self.shuffle:
+            return np.arange(num)
+        return np.random.permutation(num)
+
+    def _reset_stats(self):
+        self._num_gets = 0
+        self._total_depth = 0
+        self._total_wait = 0.0
+
+    def queue_stats(self):
+        """Stats of the last (or current) epoch with prefetch.
+
+        return: mean number of staged batches seen by the consumer,
+                total seconds the consumer waited for a batch
+        """
+        mean_depth = self._total_depth / float(max(self._num_gets, 1))
+        return mean_depth, self._total_wait
+
+    def _batches(self):
+        """Yield (rows, batch_idx, buf), gather rows[batch_idx] into buf."""
+        if isinstance(self.xs, H5Array):
+            batches = self._window_batches()
+        else:
+            idx = self._index(len(self.xs))
+            batches = ((self.xs, batch_idx)
+                       for batch_idx in self._index_batches(idx))
+        for i, (rows, batch_idx) in enumerate(batches):
+            buf = self._buffers[i % len(self._buffers)][:len(batch_idx)]
+            yield rows, batch_idx, buf
+
+    def _index_batches(self, idx):
+        for b in range(0, len(idx), self.batch_size):
+            yield idx[b:b+self.batch_size]
+
+    def _window_batches(self):
+        """Read the H5Array xs window by window, yield in-memory batches."""
+        chunk_len = self.xs.chunk_len
+        num_chunks = int(np.ceil(len(self.xs) / float(chunk_len)))
+        window = max(1, WINDOW_BYTES // (chunk_len * self.xs.row_bytes))
+        chunk_order = (np.random.permutation(num_chunks) if self.shuffle
+                       else np.arange(num_chunks))
+        carry = None
+        for w in range(0, num_chunks, window):
+            rows = self.xs.read_chunks(chunk_order[w:w+window])
+            if carry is not None:
+                rows = np.concatenate([carry, rows])
+            idx = self._index(len(rows))
+            num_full = len(rows) // self.batch_size * self.batch_size
+            for batch_idx in self._index_batches(idx[:num_full]):
+                yield rows, batch_idx
+            carry = rows[idx[num_full:]]
+        if carry is not None and len(carry):
+            yield carry, np.arange(len(carry))
+
+    def _gather(self, rows, batch_idx, out):
+        return np.take(rows, batch_idx, axis=0, out=out, mode='clip')
+
+    def __iter__(self):
+        if not self.prefetch:
+            for rows, batch_idx, buf in self._batches():
+                yield self._gather(rows, batch_idx, buf)
+            return
+
+        queue = Queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        self._reset_stats()
+
+        def produce():
+            for rows, batch_idx, buf in self._batches():
+                if stop.is_set():
+                    return
+                queue.put(self._gather(rows, batch_idx, buf))
+            queue.put(None)
+
+        thread = threading.Thread(target=produce)
+        thread.daemon = True
+        thread.start()
+        try:
+            while True:
+                depth = queue.qsize()
+                t = time.time()
+                batch = queue.get()
+                wait = time.time() - t
+                # the end of epoch marker is not a batch, leave it out of stats
+                if batch is None:
+                    break
+                self._total_depth += depth
+                self._total_wait += wait
+                self._num_gets += 1
+                yield batch
+        finally:
+            # unblock the producer if the consumer stops early
+            stop.set()
+            while thread.is_alive():
+                try:
+                    queue.get_nowait()
+                except Queue.Empty:
+                    pass
+                thread.join(0.01)
+
+
+def _as_float32(xs):
+    if isinstance(xs, H5Array):
+        return xs
+    return xs.astype(np.float32, copy=False)
+
 
 class MnistWrapper(DatasetWrapper):
     @classmethod
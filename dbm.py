@@ -1,42 +1,91 @@
 import numpy as np
 import cPickle
 import os
+import h5py
 import time
 import tensorflow as tf
 import matplotlib.pyplot as plt
 import utils
+import diagnostics
+import checkpoint
+from dataset_wrapper import MinibatchIterator
 import keras_auto_encoder
 import keras_utils
 
 
-def _copy_tensor_list(tensors):
-    new_tensors = []
-    for t in tensors:
-        new_tensors.append(tf.zeros_like(t) + t)
-    return new_tensors
-
-
 class DBM(object):
-    def __init__(self, num_units, name=None):
+    def __init__(self, num_units, name=None, params_file=None):
+        """params_file: h5 with weights_i and bias_i to init params from,
+        e.g. the output of dbm_pretrain.pretrain_dbm
+        """
         self.num_units = num_units
         self.name = name if name is not None else 'dbm'
         self.weights = []
         self.biases = []
 
+        params = {}
+        if params_file:
+            with h5py.File(params_file, 'r') as hf:
+                for key in hf.keys():
+                    params[key] = np.array(hf.get(key))
+
+        def initializer(key, default):
+            if key in params:
+                return tf.constant_initializer(params[key])
+            return default
+
         with tf.variable_scope(self.name):
             for i in range(self.num_layers):
                 if i < self.num_layers - 1:
                     self.weights.append(tf.get_variable(
                         'weights_%d' % i, shape=self.num_units[i:i+2],
-                        initializer=tf.random_normal_initializer(0, 0.01)))
+                        initializer=initializer(
+                            'weights_%d' % i, tf.random_normal_initializer(0, 0.01))))
                 self.biases.append(tf.get_variable(
                     'bias_%d' % i, shape=[self.num_units[i]],
-                    initializer=tf.constant_initializer(0.0)))
+                    initializer=initializer(
+                        'bias_%d' % i, tf.constant_initializer(0.0))))
 
     @property
     def num_layers(self):
         return len(self.num_units)
 
+    def create_pcd_chains(self, num_chains):
+        """Return persistent chains of all layers as a list of Variables."""
+        with tf.variable_scope(self.name):
+            return [tf.Variable(np.random.uniform(0, 1, (num_chains, n)),
+                                dtype=tf.float32, name='pcd_%d' % i)
+                    for i, n in enumerate(self.num_units)]
+
+    def save_checkpoint(self, sess, path, pcd_chains, epoch):
+        """Atomically save params, persistent chains, epoch and np rng.
+
+        Params use the layout of params_file, so a checkpoint can also
+        init a new DBM.
+        """
+        names = (['weights_%d' % i for i in range(len(self.weights))]
+                 + ['bias_%d' % i for i in range(len(self.biases))]
+                 + ['pcd_%d' % i for i in range(len(pcd_chains))])
+        vals = sess.run(self.weights + self.biases + pcd_chains)
+        checkpoint.save(path, dict(zip(names, vals)), {'epoch': epoch})
+        print '\tCheckpoint saved to:', path
+
+    def load_checkpoint(self, sess, path, pcd_chains):
+        """Restore a checkpoint from save_checkpoint, return: epoch.
+
+        np rng is not restored here, call checkpoint.restore_rng(path)
+        once all models are built.
+        """
+        arrays, attrs = checkpoint.load(path)
+        for i, w in enumerate(self.weights):
+            w.load(arrays['weights_%d' % i], sess)
+        for i, b in enumerate(self.biases):
+            b.load(arrays['bias_%d' % i], sess)
+        for i, chain in enumerate(pcd_chains):
+            chain.load(arrays['pcd_%d' % i], sess)
+        print 'Resume from %s at epoch %d' % (path, attrs['epoch'])
+        return int(attrs['epoch'])
+
     def init_states(self, vis):
         """Return a list of states filled with tensors (not Variables)."""
         batch_size = tf.shape(vis)[0]
@@ -45,14 +94,30 @@ class DBM(object):
             states.append(tf.random_uniform([batch_size, self.num_units[i]], 0, 1))
         return states
 
+    def energy(self, states):
+        """Energy of joint states of all layers, return: [batch_size]."""
+        energy = 0
+        for i in range(self.num_layers):
+            energy -= tf.reduce_sum(states[i] * self.biases[i], 1)
+            if i < self.num_layers - 1:
+                energy -= tf.reduce_sum(
+                    tf.matmul(states[i], self.weights[i]) * states[i+1], 1)
+        return energy
+
     def _compute_probs(self, states, offset):
-        """Compute prob (in place) given a list of tensors."""
+        """Compute prob (in place) of layers offset, offset+2, ...
+
+        Layers of the same parity only read layers of the other parity, so
+        the whole block is updated from the same input states.
+        """
+        inputs = list(states)
         for i in range(offset, self.num_layers, 2):
-            pre_sigmoid = tf.zeros_like(states[i]) + self.biases[i]
+            pre_sigmoid = self.biases[i]
             if i > 0:
-                pre_sigmoid += tf.matmul(states[i-1], self.weights[i-1])
-            if i+i < self.num_layers:
-                pre_sigmoid += tf.matmul(states[i+1], tf.transpose(self.weights[i]))
+                pre_sigmoid = pre_sigmoid + tf.matmul(inputs[i-1], self.weights[i-1])
+            if i+1 < self.num_layers:
+                pre_sigmoid = pre_sigmoid + tf.matmul(
+                    inputs[i+1], self.weights[i], transpose_b=True)
             states[i] = tf.nn.sigmoid(pre_sigmoid)
 
     def _sample_probs(self, states, offset):
@@ -60,19 +125,46 @@ class DBM(object):
         for i in range(offset, self.num_layers, 2):
             states[i] = utils.sample_bernoulli(states[i])
 
-    def mean_field(self, k, states):
-        """In place mean-field updates till convergence."""
-        for i in range(k):
-            self._compute_probs(states, 1)
-            self._compute_probs(states, 2)
+    def mean_field(self, k, states, tol=1e-4):
+        """In place mean-field updates till convergence.
+
+        Runs at most k sweeps in a tf.while_loop and stops early once no
+        hidden prob changes by more than tol in a sweep.
+        return: number of sweeps done
+        """
+        def cond(i, delta, *states):
+            return tf.logical_and(tf.less(i, k), delta > tol)
+
+        def body(i, delta, *states):
+            new_states = list(states)
+            self._compute_probs(new_states, 1)
+            self._compute_probs(new_states, 2)
+            delta = tf.reduce_max(tf.stack(
+                [tf.reduce_max(tf.abs(new - old))
+                 for new, old in zip(new_states[1:], states[1:])]))
+            return [i+1, delta] + new_states
+
+        results = tf.while_loop(
+            cond, body, [0, tf.constant(np.inf)] + states, back_prop=False)
+        states[:] = results[2:]
+        return results[0]
 
     def pcd(self, k, states):
-        """In place pcd updates, input should be a list of tensor."""
-        for i in range(k):
+        """In place pcd updates in a tf.while_loop, k can be a tensor."""
+        def cond(i, *states):
+            return tf.less(i, k)
+
+        def body(i, *states):
+            states = list(states)
             self._compute_probs(states, 1)
             self._sample_probs(states, 1)
             self._compute_probs(states, 0)
             self._sample_probs(states, 0)
+            return [i+1] + states
+
+        states[:] = tf.while_loop(
+            cond, body, [0] + [tf.convert_to_tensor(s) for s in states],
+            back_prop=False)[1:]
 
     def collect_stats(self, states):
         """Collect stats given mean filed/pcd states; params not changed."""
@@ -87,10 +179,12 @@ class DBM(object):
             stats_biases.append(tf.reduce_mean(states[i], reduction_indices=[0]))
         return stats_ws, stats_biases
 
-    def compute_gradient(self, mf_states, pcd_states, mf_k, pcd_k):
-        """Compute gradients, mf_states and pcd_states will be updated in place."""
+    def compute_gradient(self, mf_states, pcd_states, mf_k):
+        """Compute gradients, mf_states will be updated in place.
+
+        pcd_states: negative phase states, already sampled
+        """
         self.mean_field(mf_k, mf_states)
-        self.pcd(pcd_k, pcd_states)
         pos_stats_ws, pos_stats_biases = self.collect_stats(mf_states)
         neg_stats_ws, neg_stats_biases = self.collect_stats(pcd_states)
 
@@ -111,19 +205,39 @@ class DBM(object):
         loss = vis * tf.log(recon_vprob) + (1-vis) * tf.log(1 - recon_vprob)
         return - tf.reduce_mean(tf.reduce_sum(loss, reduction_indices=[1]))
 
-    def train_step(self, lr, vis, pcd_states, mf_k, pcd_k):
-        mf_states = self.init_states(vis)
-        new_pcd_states = _copy_tensor_list(pcd_states)
+    def train_step(self, lr, vis, pcd_chains, mf_k, pcd_k):
+        """Return loss, updates, monitored updates and chain stats.
+
+        One run of updates advances pcd_chains (Variables from
+        create_pcd_chains) by pcd_k steps and updates the params, whose
+        negative phase reads the updated chains. Monitored updates also
+        wait for the chain stats (diagnostics.dbm_chain_stats), so the stats
+        can be fetched in the same run before the params change.
+        """
+        new_pcd_states = list(pcd_chains)
+        self.pcd(pcd_k, new_pcd_states)
+        # the assigned values, read only once the chains are updated
+        pcd_states = [chain.assign(new_state)
+                      for chain, new_state in zip(pcd_chains, new_pcd_states)]
+        stats = diagnostics.dbm_chain_stats(self, pcd_states)
 
-        dws, dbiases  = self.compute_gradient(mf_states, new_pcd_states, mf_k, pcd_k)
+        mf_states = self.init_states(vis)
+        dws, dbiases  = self.compute_gradient(mf_states, pcd_states, mf_k)
         loss = self.compute_loss(vis)
 
-        updates = []
-        for i in range(self.num_layers):
-            if i < self.num_layers - 1:
-                updates.append(self.weights[i].assign_add(lr * dws[i]))
-            updates.append(self.biases[i].assign_add(lr * dbiases[i]))
-        return loss, updates, new_pcd_states
+        def param_updates(reads):
+            updates = []
+            # all reads of params happen before they are assigned
+            with tf.control_dependencies(reads):
+                for i in range(self.num_layers):
+                    if i < self.num_layers - 1:
+                        updates.append(self.weights[i].assign_add(lr * dws[i]))
+                    updates.append(self.biases[i].assign_add(lr * dbiases[i]))
+            return updates
+
+        reads = dws + dbiases + [loss]
+        return (loss, param_updates(reads),
+                param_updates(reads + stats.values()), stats)
 
     def sample_from_dbm(self, num_examples, num_steps):
         init = tf.random_uniform([num_examples, self.num_units[0]], 0, 1)
@@ -137,69 +251,100 @@ class DBM(object):
 
 
 def train(dbm, xs, init_lr, num_epoch, batch_size,
-          mf_k, pcd_k, pcd_chain_size, output_dir):
+          mf_k, pcd_k, pcd_chain_size, output_dir, resume=True,
+          monitor_freq=10):
+    """Train dbm on xs, checkpointed every epoch to output_dir.
+
+    resume: continue from output_dir/checkpoint.h5 if it exists
+    monitor_freq: record chain stats every monitor_freq batches (0 for
+                  never), ess/sec is against wall-clock training time
+    """
     num_batches = len(xs) / batch_size
     assert num_batches * batch_size == len(xs)
 
     vis = tf.placeholder(tf.float32, (None,) + xs.shape[1:], name='vis_input')
     lr = tf.placeholder(tf.float32, (), name='lr')
 
-    pcd_states = [tf.placeholder(tf.float32, (pcd_chain_size, i)) for i in dbm.num_units]
-    pcd_vals = [np.random.uniform(0, 1, (pcd_chain_size, i)) for i in dbm.num_units]
-
-    loss, updates, new_pcd_states = dbm.train_step(lr, vis, pcd_states, mf_k, pcd_k)
+    pcd_chains = dbm.create_pcd_chains(pcd_chain_size)
+    loss, updates, monitored_updates, stats = dbm.train_step(
+        lr, vis, pcd_chains, mf_k, pcd_k)
+    trace = diagnostics.TraceRecorder(stats)
     if output_dir is not None:
         sample_imgs = dbm.sample_from_dbm(100, 1000)
+        if not os.path.exists(output_dir):
+            os.makedirs(output_dir)
+        ckpt_path = os.path.join(output_dir, 'checkpoint.h5')
     sess = utils.get_session()
     with sess.as_default():
         tf.initialize_all_variables().run()
-
-        for i in range(num_epoch):
-            np.random.shuffle(xs)
+        start_epoch = 0
+        if resume and output_dir is not None and os.path.exists(ckpt_path):
+            start_epoch = dbm.load_checkpoint(sess, ckpt_path, pcd_chains)
+
+        if start_epoch:
+            # after the keras models, whose init draws from np.random
+            checkpoint.restore_rng(ckpt_path)
+        # shuffles an index, xs is never reordered
+        batches = MinibatchIterator(xs, batch_size)
+        for i in range(start_epoch, num_epoch):
             t = time.time()
             loss_vals = np.zeros(num_batches)
-            for b in range(num_batches):
-                batch_xs = xs[b*batch_size : (b+1)*batch_size]
+            trace_t = t
+            for b, batch_xs in enumerate(batches):
                 feed_dict = {vis: batch_xs,
                              lr: utils.scheduled_lr(init_lr, i, num_epoch)}
-                for key, val in zip(pcd_states, pcd_vals):
-                    feed_dict[key] = val
-
-                loss_val, _, pcd_vals = sess.run(
-                    [loss, updates, new_pcd_states], feed_dict=feed_dict)
+                if monitor_freq and b % monitor_freq == 0:
+                    loss_val, _, stat_vals = sess.run(
+                        [loss, monitored_updates, trace.fetches],
+                        feed_dict=feed_dict)
+                    trace.append(stat_vals, time.time() - trace_t)
+                    trace_t = time.time()
+                else:
+                    loss_val, _ = sess.run([loss, updates], feed_dict=feed_dict)
                 loss_vals[b] = loss_val
             print 'Epoch: %d, Train Loss: %s' % (i, loss_vals.mean())
             print '\tTime took:', time.time() - t
+            if monitor_freq:
+                trace.report()
+            trace.reset()
 
             if output_dir is not None:
-                if not os.path.exists(output_dir):
-                    os.makedirs(output_dir)
+                dbm.save_checkpoint(sess, ckpt_path, pcd_chains, i+1)
                 imgs = sess.run(sample_imgs)
                 img_path = os.path.join(output_dir, 'epoch%d-plot.png' % i)
                 utils.vis_samples(imgs, 10, 10, (28, 28), img_path)
 
 
 def train_with_decoder(dbm, xs, init_lr, num_epoch, batch_size,
-                       mf_k, pcd_k, pcd_chain_size, output_dir, decoder_dir):
+                       mf_k, pcd_k, pcd_chain_size, output_dir, decoder_dir,
+                       resume=True, monitor_freq=10):
+    """Train dbm on encoded xs, checkpointed every epoch to output_dir.
+
+    resume, monitor_freq: see train
+    """
     num_batches = len(xs) / batch_size
     assert num_batches * batch_size == len(xs)
 
     vis = tf.placeholder(tf.float32, (None,) + xs.shape[1:], name='vis_input')
     lr = tf.placeholder(tf.float32, (), name='lr')
 
-    pcd_states = [tf.placeholder(tf.float32, (pcd_chain_size, i)) for i in dbm.num_units]
-    pcd_vals = [np.random.uniform(0, 1, (pcd_chain_size, i)) for i in dbm.num_units]
-
-    loss, updates, new_pcd_states = dbm.train_step(lr, vis, pcd_states, mf_k, pcd_k)
+    pcd_chains = dbm.create_pcd_chains(pcd_chain_size)
+    loss, updates, monitored_updates, stats = dbm.train_step(
+        lr, vis, pcd_chains, mf_k, pcd_k)
+    trace = diagnostics.TraceRecorder(stats)
     if output_dir is not None:
         sample_imgs = dbm.sample_from_dbm(100, 1000)
         output_dir = os.path.join(decoder_dir, output_dir)
         if not os.path.exists(output_dir):
             os.makedirs(output_dir)
+        ckpt_path = os.path.join(output_dir, 'checkpoint.h5')
 
     sess = utils.get_session()
     with sess.as_default():
         tf.initialize_all_variables().run()
+        start_epoch = 0
+        if resume and output_dir is not None and os.path.exists(ckpt_path):
+            start_epoch = dbm.load_checkpoint(sess, ckpt_path, pcd_chains)
 
         encoder, decoder = keras_utils.load_encoder_decoder(
             (32, 32, 3),
@@ -207,28 +352,36 @@ def train_with_decoder(dbm, xs, init_lr, num_epoch, batch_size,
             keras_auto_encoder.deep_decoder1, os.path.join(decoder_dir, 'decoder')
         )
 
-        for i in range(num_epoch):
-            np.random.shuffle(xs)
+        if start_epoch:
+            # after the keras models, whose init draws from np.random
+            checkpoint.restore_rng(ckpt_path)
+        # shuffles an index, xs is never reordered
+        batches = MinibatchIterator(xs, batch_size)
+        for i in range(start_epoch, num_epoch):
             t = time.time()
             loss_vals = np.zeros(num_batches)
-            for b in range(num_batches):
-                batch_xs = xs[b*batch_size : (b+1)*batch_size]
+            trace_t = t
+            for b, batch_xs in enumerate(batches):
                 feed_dict = {vis: batch_xs,
                              lr: utils.scheduled_lr(init_lr, i, num_epoch)}
-                for key, val in zip(pcd_states, pcd_vals):
-                    feed_dict[key] = val
-
-                loss_val, _, pcd_vals = sess.run(
-                    [loss, updates, new_pcd_states], feed_dict=feed_dict)
+                if monitor_freq and b % monitor_freq == 0:
+                    loss_val, _, stat_vals = sess.run(
+                        [loss, monitored_updates, trace.fetches],
+                        feed_dict=feed_dict)
+                    trace.append(stat_vals, time.time() - trace_t)
+                    trace_t = time.time()
+                else:
+                    loss_val, _ = sess.run([loss, updates], feed_dict=feed_dict)
                 loss_vals[b] = loss_val
             print 'Epoch: %d, Train Loss: %s' % (i+1, loss_vals.mean())
             print '\tTime took:', time.time() - t
+            if monitor_freq:
+                trace.report()
+            trace.reset()
 
+            if output_dir is not None:
+                dbm.save_checkpoint(sess, ckpt_path, pcd_chains, i+1)
             if (i+1) % 10 == 0 and output_dir is not None:
-                saver = tf.train.Saver()
-                save_path = saver.save(
-                    sess, os.path.join(output_dir, 'epoch%d.ckpt' % (i+1)))
-                print '\tModel saved to:', save_path
                 imgs = sess.run(sample_imgs)
                 img_path = os.path.join(output_dir, 'epoch%d-plot.png' % (i+1))
                 decoder_input_shape = decoder.get_input_shape_at(0)[1:]
@@ -258,7 +411,10 @@ if __name__ == '__main__':
 
 
     batch_size = 20
-    dbm = DBM([640, 500, 500], output_dir)
+    # stacked rbm params from dbm_pretrain.py, None for random init
+    params_file = None
+    # params_file = os.path.join(decoder_dir, 'dbm_pretrain', 'dbm_init.h5')
+    dbm = DBM([640, 500, 500], output_dir, params_file)
     train_with_decoder(dbm, train_xs, lr, num_epoch, batch_size,
                        mf_k, pcd_k, pcd_chain_size, output_dir, decoder_dir)
 
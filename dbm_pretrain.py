@@ -0,0 +1,142 @@
+"""Greedy layerwise pretraining of a DBM from a stack of RBMs.
+
+Follows Salakhutdinov & Hinton (2009): the bottom RBM uses its visibles
+twice on the way up (up_scale=2), the top RBM its hiddens twice on the way
+down (down_scale=2), and the weights of intermediate RBMs are halved when
+the stack is composed into a DBM, so that every DBM layer gets input from
+both of its neighbours without double counting.
+
+The hidden probs of each trained RBM are streamed to h5 with
+encoding.encode_to_h5 and read back lazily as the dataset of the next RBM.
+"""
+import os
+import h5py
+import numpy as np
+import tensorflow as tf
+
+from rbm import RBM
+from rbm_trainer import RBMTrainer
+from dataset_wrapper import DatasetWrapper
+import encoding
+import gibbs_sampler
+
+
+def layer_scales(layer, num_rbms):
+    """Return up_scale, down_scale of the layer-th RBM in the stack."""
+    if num_rbms == 1:
+        return 1.0, 1.0
+    up_scale = 2.0 if layer == 0 else 1.0
+    down_scale = 2.0 if layer == num_rbms - 1 else 1.0
+    return up_scale, down_scale
+
+
+def encode_hidden(sess, rbm, dataset, h5_path, chunk_size=1000):
+    """Write hidden probs of rbm on dataset to h5_path, return it lazily."""
+    vis = tf.placeholder(tf.float32, [None, rbm.num_vis])
+    hprob = rbm._compute_up(vis)
+
+    def encode_fn(xs):
+        return sess.run(hprob, {vis: xs})
+
+    encoding.encode_to_h5(encode_fn, dataset.train_xs, dataset.train_ys,
+                          dataset.test_xs, dataset.test_ys, h5_path, chunk_size)
+    return DatasetWrapper.load_from_h5(h5_path, lazy=True)
+
+
+def pretrain_layer(sess, rbm, dataset, train_config, vis_fn, output_dir):
+    if train_config.use_pcd:
+        sampler = gibbs_sampler.GibbsSampler.create_pcd_sampler(
+            rbm, train_config.batch_size, train_config.cd_k, loop=True)
+    else:
+        sampler = gibbs_sampler.GibbsSampler.create_cd_sampler(
+            rbm, train_config.cd_k, loop=True)
+    sampler_generator = gibbs_sampler.create_sampler_generator(
+        rbm, dataset.test_xs[:100], None, 0)
+
+    train_config.dump_log(output_dir)
+    trainer = RBMTrainer(sess, dataset, rbm, vis_fn, output_dir)
+    trainer.train(train_config, sampler, sampler_generator)
+    trainer.dump_log(output_dir)
+
+
+def stack_params(sess, rbms):
+    """Compose DBM weights and biases from a stack of trained RBMs.
+
+    Intermediate RBMs have their weights halved, the biases of a layer
+    shared by two RBMs are averaged.
+    return: list of weights, list of biases (numpy)
+    """
+    num_rbms = len(rbms)
+    params = sess.run([[rbm.weights, rbm.vbias[0], rbm.hbias[0]] for rbm in rbms])
+    weights = []
+    biases = [params[0][1]]
+    for i, (w, vbias, hbias) in enumerate(params):
+        if 0 < i < num_rbms - 1:
+            w = w / 2
+        weights.append(w)
+        if i > 0:
+            biases[i] = (biases[i] + vbias) / 2
+        biases.append(hbias)
+    return weights, biases
+
+
+def save_stacked_params(weights, biases, params_file):
+    """Write params in the layout read by DBM(..., params_file)."""
+    with h5py.File(params_file, 'w') as hf:
+        for i, w in enumerate(weights):
+            hf.create_dataset('weights_%d' % i, data=w)
+        for i, b in enumerate(biases):
+            hf.create_dataset('bias_%d' % i, data=b)
+    print 'Stacked DBM params written to %s' % params_file
+
+
+def pretrain_dbm(sess, num_units, dataset, train_configs, output_dir, vis_fn=None):
+    """Train one RBM per pair of layers, bottom up.
+
+    train_configs: one TrainConfig per RBM
+    vis_fn: used to plot samples of the bottom RBM only
+    return: path of the params file to init DBM(num_units, name, params_file)
+    """
+    num_rbms = len(num_units) - 1
+    assert len(train_configs) == num_rbms
+    rbms = []
+    for i in range(num_rbms):
+        up_scale, down_scale = layer_scales(i, num_rbms)
+        rbm = RBM(num_units[i], num_units[i+1], None, up_scale, down_scale)
+        layer_dir = os.path.join(
+            output_dir, 'layer%d_hid%d_%s' % (i, rbm.num_hid, train_configs[i]))
+        print '>>> pretrain layer %d: %d -> %d' % (i, rbm.num_vis, rbm.num_hid)
+        pretrain_layer(sess, rbm, dataset, train_configs[i],
+                       vis_fn if i == 0 else None, layer_dir)
+        rbm.save_model(sess, layer_dir, 'final_')
+        rbms.append(rbm)
+        if i < num_rbms - 1:
+            dataset = encode_hidden(
+                sess, rbm, dataset, os.path.join(layer_dir, 'hidden_probs.h5'))
+
+    params_file = os.path.join(output_dir, 'dbm_init.h5')
+    save_stacked_params(*stack_params(sess, rbms), params_file=params_file)
+    return params_file
+
+
+if __name__ == '__main__':
+    import keras.backend as K
+    from dataset_wrapper import Cifar10Wrapper
+    import cifar10_ae
+    import utils
+
+    np.random.seed(66699)
+    sess = utils.create_session()
+    K.set_session(sess)
+
+    ae_folder = 'prod/cifar10_ae2_relu_%d' % cifar10_ae.RELU_MAX
+    encoded_dataset = Cifar10Wrapper.load_from_h5(
+        os.path.join(ae_folder, 'encoded_cifar10.h5'), lazy=True)
+    assert len(encoded_dataset.x_shape) == 1
+
+    num_units = [encoded_dataset.x_shape[0], 500, 500]
+    train_configs = [
+        utils.TrainConfig(lr=0.01, batch_size=100, num_epoch=100, use_pcd=False, cd_k=1),
+        utils.TrainConfig(lr=0.01, batch_size=100, num_epoch=100, use_pcd=False, cd_k=1)]
+    output_dir = os.path.join(ae_folder, 'dbm_pretrain')
+    pretrain_dbm(sess, num_units, encoded_dataset, train_configs, output_dir)
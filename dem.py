@@ -1,6 +1,9 @@
+import os
+import numpy as np
 import tensorflow as tf
 from autoencoder import build_model
 from rbm import RBM
+import encoding
 
 
 def tf_norm(x):
@@ -61,23 +64,45 @@ class DEM(object):
                 tf.get_collection(tf.GraphKeys.TRAINABLE_VARIABLES, scope=name))
         return trainable_vars
 
-    def encode(self, sess, dataset, dataset_cls):
+    def encode(self, sess, dataset, dataset_cls, train_set_size=1000,
+               h5_path=None, chunk_size=1000):
+        """Encode x to hidden probs of rbm, in chunks of chunk_size.
+
+        train_set_size: number of train examples to encode, None for all
+        h5_path: stream codes to h5_path (resumable) and return a lazy
+                 dataset on it, see encoding.encode_to_h5
+        """
         x = tf.placeholder(tf.float32, [None] + list(dataset.x_shape))
         h = self.rbm._compute_up(self.encoder(x))
-        train_set_size = 1000
-        # num_batches = len(dataset.train_xs) / batch_size
-        encoded_train_xs = sess.run(h, {x: dataset.train_xs[:train_set_size]})
-        encoded_test_xs = sess.run(h, {x: dataset.test_xs})
-        return dataset_cls(encoded_train_xs, dataset.train_ys[:train_set_size],
+
+        def encode_fn(xs):
+            return sess.run(h, {x: xs})
+
+        if h5_path:
+            encoding.encode_to_h5(encode_fn, dataset.train_xs, dataset.train_ys,
+                                  dataset.test_xs, dataset.test_ys,
+                                  h5_path, chunk_size, train_set_size)
+            return dataset_cls.load_from_h5(h5_path, lazy=True)
+
+        encoded_train_xs = encoding.encode_chunks(
+            encode_fn, dataset.train_xs, chunk_size, train_set_size)
+        encoded_test_xs = encoding.encode_chunks(
+            encode_fn, dataset.test_xs, chunk_size)
+        train_ys = dataset.train_ys[:len(encoded_train_xs)]
+        return dataset_cls(encoded_train_xs, train_ys,
                            encoded_test_xs, dataset.test_ys)
 
     def free_energy(self, z):
         """build the graph to compute free energy given z :: placeholder"""
         return self.rbm.free_energy(z)
 
-    def free_energy_wrt_x(self, x):
-        """build the graph to compute free energy given x :: placeholder"""
-        z = self.encoder(x)
+    def free_energy_wrt_x(self, x, z=None):
+        """build the graph to compute free energy given x :: placeholder
+
+        z: self.encoder(x) if already built, to share the encoder pass
+        """
+        if z is None:
+            z = self.encoder(x)
         fe = tf.reduce_mean(self.rbm.free_energy(z))
         # dfe_dz = tf.gradients(fe, z)[0]
         # grad_norm = tf_mean_norm(dfe_dz)
@@ -100,8 +125,11 @@ class DEM(object):
         """
         return self.rbm.loss_and_cost(z_data, z_model)
 
-    def autoencoder_cost(self, x):
-        x_recon = self.decoder(self.encoder(x))
+    def autoencoder_cost(self, x, z=None):
+        """z: self.encoder(x) if already built, to share the encoder pass"""
+        if z is None:
+            z = self.encoder(x)
+        x_recon = self.decoder(z)
         cost = tf.reduce_mean(tf.square(x_recon - x))
         # dcost_dx_recon = tf.gradients(cost, x_recon)[0]
         # grad_norm = tf_mean_norm(dcost_dx_recon)
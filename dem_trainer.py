@@ -4,8 +4,14 @@ import tensorflow as tf
 import numpy as np
 import os
 import utils
-import math
 import time
+import checkpoint
+import diagnostics
+from dataset_wrapper import MinibatchIterator
+
+
+def _reduce_std(x):
+    return tf.sqrt(tf.reduce_mean(tf.square(x - tf.reduce_mean(x))))
 
 
 class DEMTrainer(object):
@@ -58,15 +64,26 @@ class DEMTrainer(object):
         output_path =  os.path.join(self.output_dir, 'test_decode.png')
         self._save_samples(x, output_path)
 
-    def train(self, train_config, sampler, sampler_generator):
+    def train(self, train_config, sampler, sampler_generator, prefetch=2,
+              checkpoint_path=None, checkpoint_freq=10, stage=0, resume=True,
+              monitor_freq=10):
+        """prefetch: number of upcoming x_data batches staged in a queue
+        monitor_freq: with a persistent sampler, record chain stats every
+                      monitor_freq batches (0 for never), see RBMTrainer.train
+        checkpoint_path, checkpoint_freq, stage, resume: see RBMTrainer.train,
+        the checkpoint also holds the encoder and decoder weights
+        """
         # building graphs
         # encoder_x = tf.placeholder(tf.float32, self.x_shape)
         # encoder_target_z = tf.placeholder(tf.float32, self.z_shape)
         # encoder_cost = self.dem.encoder_cost(encoder_x, encoder_target_z)
 
         ae_x = tf.placeholder(tf.float32, self.x_shape)
-        encoder_fe_cost = self.dem.free_energy_wrt_x(ae_x)
-        ae_cost = self.dem.autoencoder_cost(ae_x)
+        # single encoder application per batch, shared by the free energy
+        # term, the autoencoder reconstruction and the rbm positive phase
+        z = self.dem.encoder(ae_x)
+        encoder_fe_cost = self.dem.free_energy_wrt_x(ae_x, z)
+        ae_cost = self.dem.autoencoder_cost(ae_x, z)
         ae_vars = self.dem.get_trainable_vars(['encoder', 'decoder'])
 
         fe_cost_factor = 5e-5
@@ -77,70 +94,115 @@ class DEMTrainer(object):
         aec_grad_mean = tf.reduce_mean(
             tf.abs(tf.gradients(ae_cost, encoder_final_conv)[0]))
 
-        rbm_z_data = tf.placeholder(tf.float32, self.z_shape)
-        rbm_z_model = tf.placeholder(tf.float32, self.z_shape)
-        rbm_loss, rbm_cost = self.dem.rbm_loss_and_cost(rbm_z_data, rbm_z_model)
-
-        opt_rbm = tf.train.GradientDescentOptimizer(
-            train_config.lr).minimize(rbm_cost)
-        opt_ae = tf.train.GradientDescentOptimizer(
-            0.01).minimize(ae_cost + fe_cost_factor * encoder_fe_cost, var_list=ae_vars)
-
+        rbm_z_data = tf.stop_gradient(z)
         if sampler.is_persistent:
             print '>>>>>>>> using pcd-%d' % train_config.cd_k
             sample_op, sampler_updates = sampler.sample()
         else:
             print '>>>>>>>> using cd-%d' % train_config.cd_k
             sample_op, sampler_updates = sampler.sample(rbm_z_data)
+        rbm_z_model = tf.stop_gradient(sample_op)
+        rbm_loss, rbm_cost = self.dem.rbm_loss_and_cost(rbm_z_data, rbm_z_model)
+        trace_stats = {}
+        if sampler.is_persistent:
+            trace_stats = diagnostics.rbm_chain_stats(self.dem.rbm, rbm_z_model)
+        trace = diagnostics.TraceRecorder(trace_stats)
+
+        ae_optimizer = tf.train.GradientDescentOptimizer(0.01)
+        opt_ae = ae_optimizer.minimize(
+            ae_cost + fe_cost_factor * encoder_fe_cost, var_list=ae_vars)
+        # the ae gradient and all monitors read the rbm before it is updated
+        rbm_optimizer = tf.train.GradientDescentOptimizer(train_config.lr)
+        rbm_grads_and_vars = rbm_optimizer.compute_gradients(rbm_cost)
+        rbm_reads = [opt_ae, ae_cost, encoder_fe_cost, rbm_loss]
+        with tf.control_dependencies(rbm_reads):
+            opt_rbm = rbm_optimizer.apply_gradients(rbm_grads_and_vars)
+        # chain stats only run on monitored batches
+        with tf.control_dependencies(rbm_reads + trace.fetches):
+            monitored_opt_rbm = rbm_optimizer.apply_gradients(rbm_grads_and_vars)
+
+        z_data_stats = [tf.reduce_mean(rbm_z_data), _reduce_std(rbm_z_data)]
+        z_model_stats = [tf.reduce_mean(rbm_z_model), _reduce_std(rbm_z_model)]
 
         # finish building all graphs, init only new variables
         utils.initialize_uninitialized_variables_by_keras()
         # self._test_init()
 
-        num_batches = int(math.ceil(
-            len(self.train_xs) / float(train_config.batch_size)))
-
-        for e in range(train_config.num_epoch):
+        ckpt = None
+        start_epoch = 0
+        if checkpoint_path:
+            model_weights = self._model_weights()
+            rbm_params = {'rbm/weights': self.dem.rbm.weights,
+                          'rbm/vbias': self.dem.rbm.vbias,
+                          'rbm/hbias': self.dem.rbm.hbias}
+            ae_params = dict((key, var) for key, var in model_weights.items()
+                             if any(var is v for v in ae_vars))
+            ckpt_vars = dict(model_weights)
+            ckpt_vars.update(rbm_params)
+            ckpt_vars.update(checkpoint.optimizer_slots(
+                ae_optimizer, ae_params, 'ae_optimizer'))
+            ckpt_vars.update(checkpoint.optimizer_slots(
+                rbm_optimizer, rbm_params, 'rbm_optimizer'))
+            if sampler.is_persistent:
+                ckpt_vars['rbm/pcd_chain_stage%d' % stage] = sampler.samples
+            ckpt = checkpoint.TrainingCheckpoint(self.sess, checkpoint_path, ckpt_vars)
+            if resume and ckpt.exists():
+                ckpt_stage, _ = ckpt.progress()
+                if ckpt_stage > stage:
+                    print 'Stage %d already done in %s, skip.' % (stage, checkpoint_path)
+                    ckpt.close()
+                    return
+                if ckpt_stage == stage:
+                    _, start_epoch, self.log = ckpt.restore()
+
+        # shuffles an index, self.train_xs is never reordered
+        batches = MinibatchIterator(
+            self.train_xs, train_config.batch_size, prefetch=prefetch)
+        num_batches = len(batches)
+        sampler_feed = sampler.feed_dict()
+        # decoder.input is only read for its batch size, see cifar10_ae.decode
+        decoder_input_feed = np.zeros(
+            (train_config.batch_size, self.dem.num_z), np.float32)
+
+        for e in range(start_epoch, train_config.num_epoch):
             t = time.time()
-            np.random.shuffle(self.train_xs)
             loss_vals = {'decoder': np.zeros(num_batches),
                          'rbm': np.zeros(num_batches),
                          'encoder': np.zeros(num_batches)}
+            trace.reset()
+            trace_t = t
 
-            for b in range(num_batches):
-                x_data = self.train_xs[b * train_config.batch_size
-                                       :(b+1) * train_config.batch_size]
-                # upward pass
-                z_data = self.dem.encoder.predict(x_data)
-                # run sampler, get z_model
-                feed_dict = {} if sampler.is_persistent else {rbm_z_data: z_data}
-                z_model, _ = self.sess.run([sample_op, sampler_updates], feed_dict)
-
-                print 'z_data, mean: %s, std:%s' % (z_data.mean(), z_data.std())
-                print 'z_model, mean: %s, std:%s' % (z_model.mean(), z_model.std())
-
-                # # downward pass
-                # x_model = self.dem.decoder.predict(z_model)
-
+            for b, x_data in enumerate(batches):
                 # check gradient magnitute
                 # grad_fe, grad_ae = self.sess.run(
                 #     [efc_grad_mean, aec_grad_mean],
                 #     {ae_x: x_data,
-                #      self.dem.decoder.input: z_data,
+                #      self.dem.decoder.input: decoder_input_feed[:len(x_data)],
                 #      K.learning_phase(): 1})
                 # print 'grad_fe:', grad_fe, 'grad_ae:', grad_ae
 
-                # update encoder decoder weights
+                # upward pass, sampler, encoder decoder and rbm updates
                 feed_dict = {ae_x: x_data,
-                             self.dem.decoder.input: z_data, # for batch_size
+                             self.dem.decoder.input: decoder_input_feed[:len(x_data)],
                              K.learning_phase(): 1} # for noise
-                loss_vals['decoder'][b],loss_vals['encoder'][b], _ = self.sess.run(
-                    [ae_cost, encoder_fe_cost, opt_ae], feed_dict)
-
-                # update rbm weights
-                feed_dict = {rbm_z_data: z_data, rbm_z_model: z_model}
-                loss_vals['rbm'][b], _ = self.sess.run(
-                    [rbm_loss, opt_rbm], feed_dict)
+                feed_dict.update(sampler_feed)
+                monitored = (trace.names and monitor_freq
+                             and b % monitor_freq == 0)
+                (loss_vals['decoder'][b], loss_vals['encoder'][b],
+                 loss_vals['rbm'][b], z_data_vals, z_model_vals, _, _, _,
+                 stat_vals) \
+                    = self.sess.run(
+                        [ae_cost, encoder_fe_cost, rbm_loss,
+                         z_data_stats, z_model_stats, opt_ae,
+                         monitored_opt_rbm if monitored else opt_rbm,
+                         sampler_updates,
+                         trace.fetches if monitored else []], feed_dict)
+                if monitored:
+                    trace.append(stat_vals, time.time() - trace_t)
+                    trace_t = time.time()
+
+                print 'z_data, mean: %s, std:%s' % tuple(z_data_vals)
+                print 'z_model, mean: %s, std:%s' % tuple(z_model_vals)
 
             self.log.append(
                 'Epoch %d, RBM Loss: %.4f, Deocder Loss: %.4f, Encoder Loss: %.4f' \
@@ -148,6 +210,12 @@ class DEMTrainer(object):
                    loss_vals['decoder'].mean(), loss_vals['encoder'].mean()))
             print self.log[-1]
             print '\tTime Taken: %ss' % (time.time() - t)
+            if trace.names:
+                trace.report()
+            if prefetch:
+                mean_depth, wait_time = batches.queue_stats()
+                print '\tInput queue depth: %.2f/%d, input wait: %.4fs' \
+                    % (mean_depth, prefetch, wait_time)
 
             if True:
                 el1_weights = self.dem.encoder.layers[1].get_weights()
@@ -167,6 +235,25 @@ class DEMTrainer(object):
                 self.dem.save_model(self.sess, self.output_dir, 'epoch_%d_' % (e+1))
                 self.dump_log()
                 # self._save_samples(x_model, chain_path)
+            if ckpt and ((e+1) % checkpoint_freq == 0
+                         or e+1 == train_config.num_epoch):
+                ckpt.save(stage, e+1, self.log)
+        if ckpt:
+            ckpt.close()
+
+    def _model_weights(self):
+        """All keras weights of encoder and decoder, incl. non-trainable.
+
+        return: dict of checkpoint key -> Variable, keyed by model and
+                position since keras names depend on the build order
+        """
+        weights = {}
+        for name, model in [('encoder', self.dem.encoder),
+                            ('decoder', self.dem.decoder)]:
+            model_weights = model.trainable_weights + model.non_trainable_weights
+            for i, var in enumerate(model_weights):
+                weights['%s/%d' % (name, i)] = var
+        return weights
 
     def dump_log(self, output_dir=None):
         if output_dir is None:
@@ -177,17 +264,10 @@ class DEMTrainer(object):
             f.write('\n')
 
     def _draw_samples(self, sampler):
-        """Use a new sampler to draw samples from the trained model.
+        """Reseed the reusable sampler and draw samples from the trained model.
         """
         assert sampler.is_persistent
-        # init new variables created by new sampler
-        utils.initialize_uninitialized_variables_by_keras()
-
-        sample_op, sampler_updates = sampler.sample()
-        for i in range(sampler.burnin):
-            self.sess.run([sample_op, sampler_updates])
-
-        samples, _ = self.sess.run([sample_op, sampler_updates])
+        samples = sampler.draw(self.sess)
         print 'in _draw_samples: samples min: %.4f, max: %.4f' \
             % (samples.min(), samples.max())
         return samples
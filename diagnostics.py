@@ -0,0 +1,139 @@
+"""Mixing diagnostics of MCMC chains: autocorrelation, ESS and R-hat.
+
+Traces are numpy arrays of shape [num_samples, num_chains, ...], every
+trailing dimension is treated as an independent scalar statistic. Chain
+statistics to trace (free energy, magnetization, hidden activation) are
+built as tf ops of shape [num_chains] and collected by TraceRecorder.
+"""
+import time
+import numpy as np
+import tensorflow as tf
+
+
+def autocorrelation(x):
+    """Autocorrelation of every chain at all lags, computed with FFT.
+
+    x: [num_samples, num_chains, ...]
+    return: rho of the same shape as x, rho[0] = 1
+    """
+    num_samples = len(x)
+    x = np.asarray(x, dtype=np.float64)
+    x = x - x.mean(axis=0)
+    # zero pad to avoid circular correlation
+    fft_len = 2 ** int(np.ceil(np.log2(2 * num_samples)))
+    spectrum = np.fft.rfft(x, n=fft_len, axis=0)
+    acov = np.fft.irfft(spectrum * np.conjugate(spectrum), n=fft_len, axis=0)
+    acov = acov[:num_samples]
+    return acov / np.maximum(acov[:1], 1e-300)
+
+
+def integrated_autocorr_time(x):
+    """tau = 1 + 2 sum_t rho_t, with rho averaged over chains.
+
+    The sum is truncated at the first negative lag.
+    return: tau of shape x.shape[2:]
+    """
+    rho = autocorrelation(x).mean(axis=1)
+    positive = np.cumprod(rho[1:] > 0, axis=0)
+    return 1 + 2 * np.sum(rho[1:] * positive, axis=0)
+
+
+def effective_sample_size(x):
+    """ESS pooled over chains, num_samples * num_chains / tau."""
+    num_samples, num_chains = np.shape(x)[:2]
+    return num_samples * num_chains / integrated_autocorr_time(x)
+
+
+def potential_scale_reduction(x):
+    """Split R-hat, every chain is split in halves before comparing them.
+
+    Values close to 1 mean the chains agree with each other.
+    """
+    x = np.asarray(x, dtype=np.float64)
+    half = len(x) // 2
+    x = np.concatenate([x[:half], x[-half:]], axis=1)
+    within = x.var(axis=0, ddof=1).mean(axis=0)
+    between = x.mean(axis=0).var(axis=0, ddof=1)
+    var_estimate = (half - 1.0) / half * within + between
+    return np.sqrt(var_estimate / np.maximum(within, 1e-300))
+
+
+def chain_stats(vis, free_energy, hprob=None):
+    """Per-chain scalar statistics to trace, dict of [num_chains] tensors.
+
+    magnetization: mean of 2v - 1 over all visible units
+    hidden_activation: mean of hprob over hidden units (if given)
+    """
+    vis = tf.reshape(vis, [tf.shape(vis)[0], -1])
+    stats = {'free_energy': free_energy,
+             'magnetization': tf.reduce_mean(2 * vis - 1, 1)}
+    if hprob is not None:
+        stats['hidden_activation'] = tf.reduce_mean(hprob, 1)
+    return stats
+
+
+def rbm_chain_stats(rbm, vis):
+    h_total_input = rbm.h_total_input(vis)
+    return chain_stats(vis, rbm.free_energy(vis, h_total_input),
+                       rbm._compute_up(vis, h_total_input))
+
+
+def dbm_chain_stats(dbm, states):
+    """Stats of dbm chains, energy of the joint state replaces free energy."""
+    return chain_stats(states[0], dbm.energy(states), states[1])
+
+
+class TraceRecorder(object):
+    """Record traces of chain statistics and summarize their mixing.
+
+    stats: dict of name -> [num_chains] tensor, e.g. sampler.trace_stats()
+    Either call run() to drive the sampler, or add fetches to an existing
+    sess.run and pass the fetched values to append() together with the time
+    spent on sampling.
+    """
+    def __init__(self, stats):
+        self.names = sorted(stats)
+        self.fetches = [stats[name] for name in self.names]
+        self.reset()
+
+    def reset(self):
+        self.traces = dict((name, []) for name in self.names)
+        self.elapsed = 0.0
+
+    def append(self, stat_vals, elapsed=0.0):
+        for name, val in zip(self.names, stat_vals):
+            self.traces[name].append(np.array(val))
+        self.elapsed += elapsed
+
+    def run(self, sess, sampler_updates, num_steps, feed_dict=None):
+        """Run num_steps sampler updates, record stats after each of them.
+
+        Only the sampler updates are timed.
+        """
+        for _ in range(num_steps):
+            t = time.time()
+            sess.run(sampler_updates, feed_dict)
+            elapsed = time.time() - t
+            self.append(sess.run(self.fetches, feed_dict), elapsed)
+
+    def summary(self):
+        """Return dict of name -> (tau, ess, r_hat, ess_per_sec)."""
+        results = {}
+        for name in self.names:
+            trace = np.array(self.traces[name])
+            ess = effective_sample_size(trace)
+            results[name] = (integrated_autocorr_time(trace), ess,
+                             potential_scale_reduction(trace),
+                             ess / max(self.elapsed, 1e-12))
+        return results
+
+    def report(self):
+        num_samples = len(self.traces[self.names[0]])
+        if num_samples < 4:
+            print 'Chain diagnostics need at least 4 samples, got %d.' % num_samples
+            return
+        print 'Chain diagnostics over %d samples, %.2fs of sampling:' \
+            % (num_samples, self.elapsed)
+        for name, (tau, ess, r_hat, ess_per_sec) in sorted(self.summary().items()):
+            print '\t%s: tau: %.2f, ess: %.1f, r_hat: %.4f, ess/sec: %.2f' \
+                % (name, tau, ess, r_hat, ess_per_sec)
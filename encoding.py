@@ -0,0 +1,98 @@
+"""Chunked, resumable encoding of datasets into h5 files.
+
+Output files use the layout of DatasetWrapper.dump_to_h5 (train_xs,
+train_ys, test_xs, test_ys), e.g. encoded_cifar10.h5, and can be opened
+with DatasetWrapper.load_from_h5(path, lazy=True).
+"""
+from multiprocessing.pool import ThreadPool
+import h5py
+import numpy as np
+
+
+def _num_rows(xs, num):
+    return len(xs) if num is None else min(num, len(xs))
+
+
+def encode_chunks(encode_fn, xs, chunk_size=1000, num=None):
+    """Encode the first num (default all) xs chunk by chunk into memory.
+
+    Only one chunk of a lazy H5Array xs is read at a time.
+    """
+    num = _num_rows(xs, num)
+    return np.concatenate([encode_fn(xs[b:min(b + chunk_size, num)])
+                           for b in range(0, num, chunk_size)])
+
+
+def _encode_xs(hf, name, xs, encode_fn, chunk_size, pool, num=None):
+    """Encode the first num xs into hf[name], resuming from hf.attrs.
+
+    encode_fn runs on the calling thread. pool reads the next chunk of xs
+    and writes the previous chunk of codes while the current one is
+    encoded, writes are done one at a time and in order.
+    """
+    progress_key = name + '_num_encoded'
+    num = _num_rows(xs, num)
+    start = hf.attrs.get(progress_key, 0)
+    if start >= num:
+        print '%s already encoded, skip.' % name
+        return
+    if start:
+        print 'resume encoding %s from %d/%d' % (name, start, num)
+
+    def read_chunk(b):
+        return xs[b:min(b + chunk_size, num)]
+
+    def write_chunk(b, zs):
+        hf[name][b:b+len(zs)] = zs
+        hf.attrs[progress_key] = b + len(zs)
+        hf.flush()
+
+    next_xs = pool.apply_async(read_chunk, (start,))
+    pending_write = None
+    try:
+        for b in range(start, num, chunk_size):
+            chunk_xs = next_xs.get()
+            if b + chunk_size < num:
+                next_xs = pool.apply_async(read_chunk, (b + chunk_size,))
+            zs = encode_fn(chunk_xs)
+            if pending_write is not None:
+                pending_write.get()
+            if name not in hf:
+                hf.create_dataset(
+                    name, (num,) + zs.shape[1:], dtype=np.float32,
+                    chunks=(min(chunk_size, num),) + zs.shape[1:])
+            pending_write = pool.apply_async(write_chunk, (b, zs))
+    finally:
+        # finish the last write before hf is closed, even on error
+        if pending_write is not None:
+            pending_write.get()
+
+
+def encode_to_h5(encode_fn, train_xs, train_ys, test_xs, test_ys, h5_path,
+                 chunk_size=1000, num_train=None):
+    """Encode train/test xs with encode_fn and stream the codes to h5_path.
+
+    encode_fn: maps a chunk of xs to a numpy array of codes, it is only
+               called from the calling thread, so keras predict and
+               sess.run need no extra locking
+    num_train: encode only the first num_train train xs (and ys)
+    xs can be numpy arrays or lazy H5Array, they are read one chunk at a
+    time on a background thread, which also writes the codes. Progress is
+    recorded in the h5 attrs after every chunk, so an interrupted call
+    resumes where it stopped when called again with the same h5_path.
+    """
+    num_train = _num_rows(train_xs, num_train)
+    pool = ThreadPool(1)
+    try:
+        with h5py.File(h5_path, 'a') as hf:
+            if 'train_ys' not in hf:
+                hf.create_dataset('train_ys', data=train_ys[:num_train])
+                hf.create_dataset('test_ys', data=test_ys)
+            _encode_xs(hf, 'train_xs', train_xs, encode_fn, chunk_size, pool,
+                       num_train)
+            _encode_xs(hf, 'test_xs', test_xs, encode_fn, chunk_size, pool)
+    finally:
+        pool.close()
+        pool.join()
+    print 'Encoded dataset written to %s' % h5_path
+    return h5_path
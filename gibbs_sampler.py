@@ -1,30 +1,46 @@
 import tensorflow as tf
 import numpy as np
+import utils
+import diagnostics
 
 
 class GibbsSampler(object):
-    """Gibbs sampler for RBM to produce CD / PCD chain."""
-    def __init__(self, init_vals, rbm, cd_k, burnin):
+    """Gibbs sampler for RBM to produce CD / PCD chain.
+
+    With loop=True, the k-step chain is built with tf.while_loop so that the
+    graph size is constant in k. k is then read from k_node, which defaults
+    to cd_k and can be fed at run time through feed_dict().
+    """
+    def __init__(self, init_vals, rbm, cd_k, burnin, loop=False):
         if init_vals is not None:
-            self.samples = tf.Variable(init_vals, dtype=tf.float32)
+            self.samples = tf.Variable(self._chain_vals(init_vals),
+                                       dtype=tf.float32, name='gibbs_chain')
         self.rbm = rbm
         self.cd_k = cd_k
         self.burnin = burnin
+        self.loop = loop
+        if loop:
+            self.k_node = tf.placeholder_with_default(
+                np.int32(cd_k), [], name='cd_k')
 
     @classmethod
-    def create_pcd_sampler(cls, rbm, num_chains, cd_k):
+    def create_pcd_sampler(cls, rbm, num_chains, cd_k, loop=False):
         chain_shape = (num_chains, rbm.num_vis)
         random_init = np.random.normal(0.0, 1.0, chain_shape)
-        return cls(random_init, rbm, cd_k, None)
+        return cls(random_init, rbm, cd_k, None, loop)
 
     @classmethod
-    def create_cd_sampler(cls, rbm, cd_k):
-        return cls(None, rbm, cd_k, None)
+    def create_cd_sampler(cls, rbm, cd_k, loop=False):
+        return cls(None, rbm, cd_k, None, loop)
 
     @property
     def is_persistent(self):
         return hasattr(self, 'samples')
 
+    def feed_dict(self):
+        """Feed the current cd_k to the looped chain, empty if unrolled."""
+        return {self.k_node: self.cd_k} if self.loop else {}
+
     def sample(self, x_data=None):
         if self.is_persistent:
             new_samples = self.samples
@@ -32,20 +48,220 @@ class GibbsSampler(object):
             assert x_data is not None, 'Provide x_data to use CD Gibbs sampler.'
             new_samples = x_data
 
-        for _ in range(self.cd_k):
-            vprob, new_samples = self.rbm.vhv(new_samples)
+        if self.loop:
+            vprob, new_samples = self._gibbs_loop(new_samples, self.k_node)
+        else:
+            for _ in range(self.cd_k):
+                vprob, new_samples = self._sweep(new_samples)
         updates = [self.samples.assign(new_samples)] if self.is_persistent else []
-        return vprob, updates
+        return self._output(vprob), updates
+
+    def run_chain(self, num_steps, thin=0):
+        """Run num_steps Gibbs sweeps of the persistent chain in one graph.
+
+        num_steps: int or scalar int tensor
+        thin: if > 0, also keep the vprob after every thin sweeps
+        return: vprob of the last sweep, snapshots of shape
+                [num_steps / thin, num_chains, num_vis] (None if not thin),
+                updates
+        """
+        assert self.is_persistent, 'run_chain needs a persistent chain.'
+        if not thin:
+            vprob, new_samples = self._gibbs_loop(self.samples, num_steps)
+            return self._output(vprob), None, [self.samples.assign(new_samples)]
+
+        # run the remainder first so that the last snapshot is the final state
+        vprob, new_samples = self._gibbs_loop(self.samples, num_steps % thin)
+        num_snapshots = num_steps // thin
+
+        def cond(i, vprob, vis_samples, snapshots):
+            return tf.less(i, num_snapshots)
+
+        def body(i, vprob, vis_samples, snapshots):
+            vprob, vis_samples = self._gibbs_loop(vis_samples, thin)
+            return i+1, vprob, vis_samples, snapshots.write(i, self._output(vprob))
+
+        snapshots = tf.TensorArray(tf.float32, size=num_snapshots)
+        _, vprob, new_samples, snapshots = tf.while_loop(
+            cond, body, [0, vprob, new_samples, snapshots], back_prop=False)
+        return (self._output(vprob), snapshots.stack(),
+                [self.samples.assign(new_samples)])
+
+    def build_draw(self):
+        """Build the reseed op and the run_chain graph used by draw().
+
+        Called once when the sampler is created for drawing, e.g. by
+        create_sampler_generator, so that the ops exist before variables
+        are initialized and repeated draws do not grow the graph.
+        """
+        assert self.is_persistent, 'draw needs a persistent chain.'
+        self.seed_vals = None
+        self.seed_node = tf.placeholder(tf.float32, self.samples.get_shape())
+        self.reseed_op = self.samples.assign(self.seed_node)
+        self.steps_node = tf.placeholder(tf.int32, [])
+        self.draw_op, _, self.draw_updates = self.run_chain(self.steps_node)
+
+    def draw(self, sess):
+        """Reseed the chain if seed_vals is set, then run burnin+1 steps."""
+        assert hasattr(self, 'draw_op'), 'call build_draw() first.'
+        if self.seed_vals is not None:
+            sess.run(self.reseed_op,
+                     {self.seed_node: self._chain_vals(self.seed_vals)})
+            self.seed_vals = None
+        num_steps = (self.burnin + 1) * self.cd_k
+        samples, _ = sess.run([self.draw_op, self.draw_updates],
+                              {self.steps_node: num_steps})
+        return samples
+
+    def trace_stats(self):
+        """Per-chain stats of the persistent chain for diagnostics.TraceRecorder."""
+        assert self.is_persistent, 'trace_stats needs a persistent chain.'
+        return diagnostics.rbm_chain_stats(self.rbm, self._output(self.samples))
+
+    def _chain_vals(self, init_vals):
+        """Map init values of the chains to the value of self.samples."""
+        return init_vals
+
+    def _output(self, vprob):
+        """Map vprob of all chains to the vprob returned to the caller."""
+        return vprob
+
+    def _sweep(self, vis_samples):
+        """One Gibbs sweep of all chains, return: vprob, vis_samples."""
+        return self.rbm.vhv(vis_samples)
+
+    def _gibbs_loop(self, vis_samples, k):
+        """Run k sweeps in a tf.while_loop, k can be a tensor."""
+        def cond(i, vprob, vis_samples):
+            return tf.less(i, k)
+
+        def body(i, vprob, vis_samples):
+            vprob, vis_samples = self._sweep(vis_samples)
+            return i+1, vprob, vis_samples
+
+        vis_samples = tf.convert_to_tensor(vis_samples)
+        _, vprob, vis_samples = tf.while_loop(
+            cond, body, [0, vis_samples, vis_samples], back_prop=False)
+        return vprob, vis_samples
+
+
+class ParallelTemperingSampler(GibbsSampler):
+    """Parallel tempering PCD sampler over a ladder of inverse temperatures.
+
+    Replica t of every chain samples from exp(-betas[t] * E(v, h)). All
+    replicas live in one [num_temps * num_chains, num_vis] variable and are
+    swept as a single batch. Before every sweep, neighbouring temperatures
+    of either the even or the odd pairs (chosen at random) exchange states
+    with a vectorized Metropolis test. Only the betas[0] = 1 replicas are
+    returned by sample() / run_chain().
+    """
+    def __init__(self, init_vals, rbm, cd_k, burnin, betas, loop=False):
+        betas = np.asarray(betas, dtype=np.float32)
+        assert betas[0] == 1.0, 'betas[0] must be 1 to sample from the rbm.'
+        assert len(betas) > 1, 'need at least 2 temperatures.'
+        self.num_temps = len(betas)
+        self.num_chains = len(init_vals)
+        self.betas = tf.constant(betas.reshape(-1, 1))
+        self.replica_betas = tf.constant(
+            np.repeat(betas, self.num_chains).reshape(-1, 1))
+        super(ParallelTemperingSampler, self).__init__(
+            init_vals, rbm, cd_k, burnin, loop)
+
+    @classmethod
+    def create_pcd_sampler(cls, rbm, num_chains, cd_k, betas, loop=False):
+        chain_shape = (num_chains, rbm.num_vis)
+        random_init = np.random.normal(0.0, 1.0, chain_shape)
+        return cls(random_init, rbm, cd_k, None, betas, loop)
+
+    def _chain_vals(self, init_vals):
+        return np.tile(init_vals, (self.num_temps, 1))
+
+    def _output(self, vprob):
+        return vprob[:self.num_chains]
+
+    def _free_energy(self, vbias_term, h_total_input, betas):
+        """Free energy at inverse temperature betas.
+
+        vbias_term: [num_temps, num_chains]
+        h_total_input: [num_temps, num_chains, num_hid]
+        betas: [num_temps, 1]
+        return: [num_temps, num_chains]
+        """
+        betas_3d = tf.expand_dims(betas, 2)
+        sum_softplus = tf.reduce_sum(utils.softplus(betas_3d * h_total_input), 2)
+        return -betas * vbias_term - sum_softplus
+
+    def _swap(self, vis_samples):
+        """Metropolis swaps between neighbouring temperatures."""
+        num_temps, num_chains = self.num_temps, self.num_chains
+        vbias_term = tf.matmul(vis_samples, self.rbm.vbias, transpose_b=True)
+        vbias_term = tf.reshape(vbias_term, [num_temps, num_chains])
+        h_total_input = self.rbm.h_total_input(vis_samples)
+        h_total_input = tf.reshape(
+            h_total_input, [num_temps, num_chains, self.rbm.num_hid])
+
+        fe = self._free_energy(vbias_term, h_total_input, self.betas)
+        # x_t at beta_{t+1} and x_{t+1} at beta_t
+        fe_up = self._free_energy(
+            vbias_term[:-1], h_total_input[:-1], self.betas[1:])
+        fe_down = self._free_energy(
+            vbias_term[1:], h_total_input[1:], self.betas[:-1])
+        # log acceptance ratio of swapping pair (t, t+1): [num_temps-1, num_chains]
+        log_ratio = fe[:-1] + fe[1:] - fe_up - fe_down
+
+        parity = tf.random_uniform([], 0, 2, dtype=tf.int32)
+        active = tf.equal(tf.range(num_temps - 1) % 2, parity)
+        log_uniform = tf.log(tf.random_uniform(tf.shape(log_ratio), 0, 1))
+        accept = tf.logical_and(tf.expand_dims(active, 1), log_uniform < log_ratio)
+        accept = tf.to_float(accept)
+
+        # state t takes x_{t+1} if pair (t, t+1) swaps, x_{t+1} takes x_t
+        no_swap = tf.zeros([1, num_chains])
+        take_next = tf.expand_dims(tf.concat([accept, no_swap], 0), 2)
+        take_prev = tf.expand_dims(tf.concat([no_swap, accept], 0), 2)
+        x = tf.reshape(vis_samples, [num_temps, num_chains, self.rbm.num_vis])
+        x_next = tf.concat([x[1:], x[-1:]], 0)
+        x_prev = tf.concat([x[:1], x[:-1]], 0)
+        x = x + take_next * (x_next - x) + take_prev * (x_prev - x)
+        return tf.reshape(x, tf.shape(vis_samples))
+
+    def _sweep(self, vis_samples):
+        vis_samples = self._swap(vis_samples)
+        h_total_input = self.rbm._up_input(self.rbm.h_total_input(vis_samples))
+        hprob = tf.nn.sigmoid(self.replica_betas * h_total_input)
+        hid_samples = utils.sample_bernoulli(hprob)
+        v_total_input = (self.rbm.down_scale * tf.matmul(
+            hid_samples, self.rbm.weights, transpose_b=True) + self.rbm.vbias)
+        vprob = tf.nn.sigmoid(self.replica_betas * v_total_input)
+        vis_samples = utils.sample_bernoulli(vprob)
+        return vprob, vis_samples
+
 
+def create_sampler_generator(rbm, init_vals, num_chain, burnin, betas=None):
+    """create sampler generator to draw sample/reconstruct test.
 
-def create_sampler_generator(rbm, init_vals, num_chain, burnin):
-    """create sampler generator to draw sample/reconstruct test."""
-    if num_chain:
+    The generator owns one sampler, built here together with its draw ops,
+    so drawing does not grow the graph. Its chain variable is initialized
+    with the other new variables (e.g. by the trainer) and reseeded with
+    init_vals or fresh random values on every call. If betas is given, the
+    sampler is a ParallelTemperingSampler.
+    """
+    if init_vals is None:
         chain_shape = (num_chain, rbm.num_vis)
+        first_vals = np.random.normal(0.0, 1.0, chain_shape)
+    else:
+        first_vals = init_vals
+    if betas is None:
+        sampler = GibbsSampler(first_vals, rbm, 1, burnin)
+    else:
+        sampler = ParallelTemperingSampler(first_vals, rbm, 1, burnin, betas)
+    sampler.build_draw()
 
     def sampler_generator(init_vals=init_vals):
         if init_vals is None:
             init_vals = np.random.normal(0.0, 1.0, chain_shape)
-        return GibbsSampler(init_vals, rbm, 1, burnin)
+        assert len(init_vals) == len(first_vals), 'fixed number of chains.'
+        sampler.seed_vals = init_vals
+        return sampler
 
     return sampler_generator
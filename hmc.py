@@ -1,6 +1,7 @@
 import tensorflow as tf
 import numpy as np
 import utils
+import diagnostics
 
 
 def kinetic_energy(vel):
@@ -25,36 +26,107 @@ def metropolis_hastings_accept(prev_energy, next_energy):
     return tf.exp(energy_diff) >= tf.random_uniform(tf.shape(prev_energy), 0, 1)
 
 
-def simulate_dynamics(init_pos, init_vel, stepsize, num_steps, potential_fn):
-    """Return final (pos, vel) obtained after num_steps leapfrog updates."""
-    # first vel is half step; pos is full step
-    potential = tf.reduce_sum(potential_fn(init_pos), 0)
-    new_vel = init_vel - 0.5 * stepsize * tf.gradients(potential, init_pos)[0]
-    new_pos = init_pos + stepsize * new_vel
+def potential_and_grad(pos, potential_fn):
+    """Return per-chain potential and its gradient wrt pos."""
+    potential = potential_fn(pos)
+    grad = tf.gradients(tf.reduce_sum(potential, 0), pos)[0]
+    return potential, grad
 
-    for _ in xrange(num_steps - 1):
-        potential = tf.reduce_sum(potential_fn(new_pos), 0)
-        new_vel = new_vel - stepsize * tf.gradients(potential, new_pos)[0]
-        new_pos = new_pos + stepsize * new_vel
-    potential = tf.reduce_sum(potential_fn(new_pos), 0)
-    new_vel = new_vel - 0.5 * stepsize * tf.gradients(potential, new_pos)[0]
-    return new_pos, new_vel
+
+def _per_chain(x, pos):
+    """Reshape per-chain values x [num_chains] to broadcast against pos."""
+    return tf.reshape(x, [-1] + [1] * (pos.get_shape().ndims - 1))
+
+
+def _leapfrog_loop(init_pos, init_vel, stepsize, num_steps, potential_fn,
+                   init_potential, init_grad):
+    """Leapfrog in a tf.while_loop with per-chain stepsize and num_steps.
+
+    Chains that have done their own num_steps keep their state while the
+    others go on, the loop runs max(num_steps) iterations.
+    return: pos, vel, potential, grad, uturn_steps, num_iters
+            uturn_steps: first step at which (pos - init_pos).vel < 0,
+                         num_steps + 1 for chains that never turned
+    """
+    num_chains = tf.shape(init_pos)[0]
+    num_steps = tf.to_int32(num_steps) * tf.ones([num_chains], tf.int32)
+    max_steps = tf.reduce_max(num_steps)
+    stepsize = _per_chain(stepsize * tf.ones([num_chains]), init_pos)
+    sum_dims = range(1, init_pos.get_shape().ndims)
+
+    def cond(i, pos, vel, potential, grad, uturn_steps):
+        return tf.less(i, max_steps)
+
+    def body(i, pos, vel, potential, grad, uturn_steps):
+        # half step vel, full step pos, half step vel with the new gradient
+        new_vel = vel - 0.5 * stepsize * grad
+        new_pos = pos + stepsize * new_vel
+        new_potential, new_grad = potential_and_grad(new_pos, potential_fn)
+        new_vel = new_vel - 0.5 * stepsize * new_grad
+
+        active = tf.less(i, num_steps)
+        pos = tf.where(active, new_pos, pos)
+        vel = tf.where(active, new_vel, vel)
+        potential = tf.where(active, new_potential, potential)
+        grad = tf.where(active, new_grad, grad)
+
+        turning = tf.reduce_sum((pos - init_pos) * vel, sum_dims) < 0
+        first_turn = tf.logical_and(
+            tf.logical_and(active, turning), uturn_steps > num_steps)
+        uturn_steps = tf.where(first_turn, tf.zeros_like(uturn_steps) + i + 1,
+                               uturn_steps)
+        return i+1, pos, vel, potential, grad, uturn_steps
+
+    num_iters, pos, vel, potential, grad, uturn_steps = tf.while_loop(
+        cond, body,
+        [0, init_pos, init_vel, init_potential, init_grad, num_steps + 1],
+        back_prop=False)
+    return pos, vel, potential, grad, uturn_steps, num_iters
+
+
+def simulate_dynamics(init_pos, init_vel, stepsize, num_steps, potential_fn,
+                      init_potential=None, init_grad=None):
+    """Return final (pos, vel, potential, grad) after num_steps leapfrog updates.
+
+    The leapfrog steps run in a tf.while_loop, so the graph holds a single
+    gradient subgraph whatever num_steps is (num_steps can be a tensor).
+    stepsize, num_steps: scalars or per-chain vectors of shape [num_chains]
+    init_potential, init_grad: potential_and_grad at init_pos if already known
+    """
+    if init_grad is None:
+        init_potential, init_grad = potential_and_grad(init_pos, potential_fn)
+    pos, vel, potential, grad, _, _ = _leapfrog_loop(
+        init_pos, init_vel, stepsize, num_steps, potential_fn,
+        init_potential, init_grad)
+    return pos, vel, potential, grad
 
 
 def hmc_sample(pos, stepsize, num_steps, potential_fn):
-    """Produce next hmc samples with a num_steps trajectory."""
+    """Produce next hmc samples with a num_steps trajectory.
+
+    stepsize: scalar or per-chain vector of shape [num_chains]
+    The MH test reuses the potentials computed by the trajectory.
+    return: per-chain acceptance (0 or 1) of shape [num_chains], new_pos
+    """
+    pos = tf.convert_to_tensor(pos)
     vel = tf.random_normal(tf.shape(pos))
-    final_pos, final_vel = simulate_dynamics(
-        pos, vel, stepsize, num_steps, potential_fn
+    potential, grad = potential_and_grad(pos, potential_fn)
+    final_pos, final_vel, final_potential, _ = simulate_dynamics(
+        pos, vel, stepsize, num_steps, potential_fn, potential, grad
     )
     accept = metropolis_hastings_accept(
-        hamiltonian(pos, vel, potential_fn),
-        hamiltonian(final_pos, final_vel, potential_fn)
+        potential + kinetic_energy(vel),
+        final_potential + kinetic_energy(final_vel)
     )
 
-    new_pos = tf.select(accept, final_pos, pos)
-    accept_rate = tf.reduce_mean(tf.cast(accept, tf.float32), 0)
-    return accept_rate, new_pos
+    new_pos = tf.where(accept, final_pos, pos)
+    return tf.cast(accept, tf.float32), new_pos
+
+
+def _trace_stats(pos, potential_fn, rbm=None):
+    pos = tf.convert_to_tensor(pos)
+    hprob = None if rbm is None else rbm._compute_up(pos)
+    return diagnostics.chain_stats(pos, potential_fn(pos), hprob)
 
 
 class HamiltonianSampler(object):
@@ -71,11 +143,18 @@ class HamiltonianSampler(object):
         """
         init_pos: initial value of the variable to be sampled
         avg_accept_slowness: used in geometric avg. 0.0 means no avg is used
+        stepsize and avg_accept_rate are kept per chain, so every chain adapts
+        its own step size from its own acceptance.
         """
+        num_chains = len(init_pos)
         # variables
         self.pos = tf.Variable(init_pos, dtype=tf.float32)
-        self.stepsize = tf.Variable(init_stepsize, dtype=tf.float32)
-        self.avg_accept_rate = tf.Variable(target_accept_rate, dtype=tf.float32)
+        self.stepsize = tf.Variable(
+            np.tile(np.float32(init_stepsize), num_chains), dtype=tf.float32)
+        self.avg_accept_rate = tf.Variable(
+            np.tile(np.float32(target_accept_rate), num_chains), dtype=tf.float32)
+        # batched gradient evaluations (all chains at once) done so far
+        self.num_grad_evals = tf.Variable(0, dtype=tf.int64)
         # constants
         self.potential_fn = potential_fn
         self.target_accept_rate = tf.constant(target_accept_rate, dtype=tf.float32)
@@ -88,27 +167,168 @@ class HamiltonianSampler(object):
 
     def sample(self):
         """Define the computation graph for one hmc sampling."""
-        accept_rate, new_pos = hmc_sample(
+        accept, new_pos = hmc_sample(
             self.pos, self.stepsize, self.num_steps, self.potential_fn
         )
         new_avg_accept_rate = tf.add(
             self.avg_accept_slowness * self.avg_accept_rate,
-            (1.0 - self.avg_accept_slowness) * accept_rate
+            (1.0 - self.avg_accept_slowness) * accept
         )
-        new_stepsize = tf.select(new_avg_accept_rate > self.target_accept_rate,
-                                 self.stepsize * self.stepsize_inc,
-                                 self.stepsize * self.stepsize_dec)
+        new_stepsize = tf.where(new_avg_accept_rate > self.target_accept_rate,
+                                self.stepsize * self.stepsize_inc,
+                                self.stepsize * self.stepsize_dec)
         new_stepsize = tf.clip_by_value(
             new_stepsize, self.stepsize_min, self.stepsize_max
         )
         updates = [self.pos.assign(new_pos),
                    self.stepsize.assign(new_stepsize),
-                   self.avg_accept_rate.assign(new_avg_accept_rate)]
+                   self.avg_accept_rate.assign(new_avg_accept_rate),
+                   self.num_grad_evals.assign_add(self.num_steps + 1)]
+        return new_pos, updates
+
+    def trace_stats(self, rbm=None):
+        """Per-chain stats for diagnostics.TraceRecorder.
+
+        The potential is traced as free energy, hidden activation needs rbm.
+        """
+        return _trace_stats(self.pos, self.potential_fn, rbm)
+
+
+class AdaptiveHamiltonianSampler(object):
+    """HMC with per-chain step sizes and trajectory lengths.
+
+    During the first num_adapt calls of sample():
+      step sizes follow dual averaging (Hoffman & Gelman, 2014) towards
+      target_accept_rate, independently for every chain;
+      trajectory lengths move towards the number of leapfrog steps after
+      which the chain makes a U-turn ((pos - init_pos).vel < 0), and grow
+      by traj_len_inc if the whole trajectory did not turn.
+    Afterwards both are frozen (the step size at its dual averaging
+    iterate average) and the number of steps of every chain is jittered
+    uniformly in [1, traj_len] to keep the chains ergodic.
+
+    Unlike NUTS there is no tree doubling: every chain runs one trajectory
+    of its own length per call, all chains share one masked while_loop.
+    """
+    def __init__(self, init_pos,
+                 potential_fn,
+                 init_stepsize=0.01,
+                 target_accept_rate=0.8,
+                 init_traj_len=10,
+                 max_traj_len=100,
+                 num_adapt=500,
+                 traj_len_inc=1.5,
+                 traj_len_slowness=0.9,
+                 gamma=0.05,
+                 t0=10.0,
+                 kappa=0.75):
+        """
+        init_pos: initial value of the variable to be sampled
+        num_adapt: number of sample() updates that adapt stepsize/traj_len
+        traj_len_slowness: used in geometric avg of the trajectory length
+        gamma, t0, kappa: dual averaging parameters
+        """
+        num_chains = len(init_pos)
+        init_stepsize = np.tile(np.float32(init_stepsize), num_chains)
+        # variables
+        self.pos = tf.Variable(init_pos, dtype=tf.float32)
+        self.stepsize = tf.Variable(init_stepsize, dtype=tf.float32)
+        self.log_avg_stepsize = tf.Variable(np.log(init_stepsize), dtype=tf.float32)
+        self.h_bar = tf.Variable(np.zeros(num_chains), dtype=tf.float32)
+        self.traj_len = tf.Variable(np.tile(np.float32(init_traj_len), num_chains),
+                                    dtype=tf.float32)
+        self.num_updates = tf.Variable(0, dtype=tf.int32)
+        # batched gradient evaluations (all chains at once) done so far
+        self.num_grad_evals = tf.Variable(0, dtype=tf.int64)
+        # constants
+        self.potential_fn = potential_fn
+        self.target_accept_rate = tf.constant(target_accept_rate, dtype=tf.float32)
+        self.max_traj_len = tf.constant(max_traj_len, dtype=tf.float32)
+        self.num_adapt = num_adapt
+        self.traj_len_inc = tf.constant(traj_len_inc, dtype=tf.float32)
+        self.traj_len_slowness = tf.constant(traj_len_slowness, dtype=tf.float32)
+        self.mu = tf.constant(np.log(10 * init_stepsize), dtype=tf.float32)
+        self.gamma = gamma
+        self.t0 = t0
+        self.kappa = kappa
+
+    def _dual_averaging(self, accept_prob):
+        """One dual averaging step, return: h_bar, log_stepsize, log_avg."""
+        t = tf.to_float(self.num_updates) + 1
+        eta = 1.0 / (t + self.t0)
+        h_bar = (1 - eta) * self.h_bar + eta * (self.target_accept_rate - accept_prob)
+        log_stepsize = self.mu - tf.sqrt(t) / self.gamma * h_bar
+        weight = t ** -self.kappa
+        log_avg_stepsize = weight * log_stepsize + (1 - weight) * self.log_avg_stepsize
+        return h_bar, log_stepsize, log_avg_stepsize
+
+    def _adapt_traj_len(self, num_steps, uturn_steps):
+        turned = uturn_steps <= num_steps
+        target = tf.where(turned, tf.to_float(uturn_steps),
+                          self.traj_len * self.traj_len_inc)
+        traj_len = tf.add(self.traj_len_slowness * self.traj_len,
+                          (1.0 - self.traj_len_slowness) * target)
+        return tf.clip_by_value(traj_len, 1.0, self.max_traj_len)
+
+    def sample(self):
+        """Define the computation graph for one hmc sampling."""
+        adapting = tf.less(self.num_updates, self.num_adapt)
+        jitter = tf.random_uniform(tf.shape(self.traj_len), 0, 1)
+        num_steps = tf.cond(adapting,
+                            lambda: tf.round(self.traj_len),
+                            lambda: tf.ceil(jitter * self.traj_len))
+        num_steps = tf.to_int32(tf.maximum(num_steps, 1.0))
+
+        pos = tf.convert_to_tensor(self.pos)
+        vel = tf.random_normal(tf.shape(pos))
+        potential, grad = potential_and_grad(pos, self.potential_fn)
+        final_pos, final_vel, final_potential, _, uturn_steps, num_iters \
+            = _leapfrog_loop(pos, vel, self.stepsize, num_steps,
+                             self.potential_fn, potential, grad)
+        energy_diff = tf.subtract(potential + kinetic_energy(vel),
+                                  final_potential + kinetic_energy(final_vel))
+        # nan energies (diverging trajectories) are rejected
+        energy_diff = tf.where(tf.is_nan(energy_diff),
+                               -np.inf * tf.ones_like(energy_diff), energy_diff)
+        accept_prob = tf.exp(tf.minimum(energy_diff, 0.0))
+        accept = tf.random_uniform(tf.shape(accept_prob), 0, 1) < accept_prob
+        new_pos = tf.where(accept, final_pos, pos)
+
+        def adapt():
+            h_bar, log_stepsize, log_avg_stepsize = self._dual_averaging(accept_prob)
+            # the last adaptation step switches to the averaged step size
+            last = tf.equal(self.num_updates + 1, self.num_adapt)
+            stepsize = tf.exp(tf.cond(last, lambda: log_avg_stepsize,
+                                      lambda: log_stepsize))
+            traj_len = self._adapt_traj_len(num_steps, uturn_steps)
+            return stepsize, h_bar, log_avg_stepsize, traj_len
+
+        def keep():
+            return (tf.identity(self.stepsize), tf.identity(self.h_bar),
+                    tf.identity(self.log_avg_stepsize),
+                    tf.identity(self.traj_len))
+
+        new_stepsize, new_h_bar, new_log_avg_stepsize, new_traj_len \
+            = tf.cond(adapting, adapt, keep)
+        updates = [self.pos.assign(new_pos),
+                   self.stepsize.assign(new_stepsize),
+                   self.h_bar.assign(new_h_bar),
+                   self.log_avg_stepsize.assign(new_log_avg_stepsize),
+                   self.traj_len.assign(new_traj_len),
+                   self.num_updates.assign_add(1),
+                   self.num_grad_evals.assign_add(tf.to_int64(num_iters) + 1)]
         return new_pos, updates
 
+    def trace_stats(self, rbm=None):
+        """Per-chain stats for diagnostics.TraceRecorder.
+
+        The potential is traced as free energy, hidden activation needs rbm.
+        """
+        return _trace_stats(self.pos, self.potential_fn, rbm)
+
 
 # test =================
-def sampler_on_nd_gaussian(burnin, num_chains, num_samples, dim):
+def sampler_on_nd_gaussian(burnin, num_chains, num_samples, dim, adaptive=False):
     # define the gaussian
     np.random.seed(666)
     mu = np.random.uniform(0, 20, dim).astype(np.float32)
@@ -124,10 +344,14 @@ def sampler_on_nd_gaussian(burnin, num_chains, num_samples, dim):
         return 0.5 * tf.reduce_sum(tf.multiply(tf.matmul(x-mu, cov_inv), x-mu), 1)
 
     init_pos = np.random.normal(size=(num_chains, dim))
-    hmc_sampler = HamiltonianSampler(
-        init_pos, gaussian_energy, init_stepsize=1, stepsize_max=5,
-        avg_accept_slowness=0.9
-    )
+    if adaptive:
+        hmc_sampler = AdaptiveHamiltonianSampler(
+            init_pos, gaussian_energy, init_stepsize=1, num_adapt=burnin)
+    else:
+        hmc_sampler = HamiltonianSampler(
+            init_pos, gaussian_energy, init_stepsize=1, stepsize_max=5,
+            avg_accept_slowness=0.9
+        )
     sample_op, updates = hmc_sampler.sample()
 
     samples = []
@@ -139,13 +363,20 @@ def sampler_on_nd_gaussian(burnin, num_chains, num_samples, dim):
         for _ in range(burnin):
             sess.run([sample_op, updates])
 
+        grad_evals_start = sess.run(hmc_sampler.num_grad_evals)
         for i in range(num_samples):
             new_sample, _ = sess.run([sample_op, updates])
             samples.append(new_sample)
+        num_grad_evals = sess.run(hmc_sampler.num_grad_evals) - grad_evals_start
         final_stepsize = sess.run(hmc_sampler.stepsize)
-        final_accept_rate = sess.run(hmc_sampler.avg_accept_rate)
+        if adaptive:
+            final_accept_rate = None
+            final_traj_len = sess.run(hmc_sampler.traj_len)
+        else:
+            final_accept_rate = sess.run(hmc_sampler.avg_accept_rate)
 
     samples = np.array(samples)
+    ess = diagnostics.effective_sample_size(samples)
     print samples.shape
     samples = samples.T.reshape(dim, -1).T
     print samples.shape
@@ -161,6 +392,10 @@ def sampler_on_nd_gaussian(burnin, num_chains, num_samples, dim):
     print '****** HMC INTERNALS ******'
     print 'final stepsize:', final_stepsize
     print 'final acceptance_rate', final_accept_rate
+    if adaptive:
+        print 'final trajectory lengths:', final_traj_len
+    print 'min ess: %.1f, gradient evals: %d, min ess per gradient eval: %.4f' \
+        % (ess.min(), num_grad_evals, ess.min() / num_grad_evals)
 
     print 'DIFF'
     print np.abs(cov - np.cov(samples.T)).sum()
@@ -169,3 +404,4 @@ def sampler_on_nd_gaussian(burnin, num_chains, num_samples, dim):
 
 if __name__ == '__main__':
     sampler_on_nd_gaussian(1000, 3, 1000, dim=5)
+    sampler_on_nd_gaussian(1000, 3, 1000, dim=5, adaptive=True)
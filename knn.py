@@ -0,0 +1,277 @@
+"""Nearest neighbour search over encoded latents (z), numpy only."""
+import time
+import h5py
+import numpy as np
+
+
+def _sq_norms(zs):
+    return np.einsum('ij,ij->i', zs, zs)
+
+
+class ExactSearch(object):
+    """Exact euclidean k-nn among a fixed set of codes zs.
+
+    Distances are computed block by block as ||q||^2 - 2 q.z + ||z||^2 with
+    one GEMM per block of zs, and a running top-k is kept across blocks.
+    ||z||^2 are computed once (or loaded with zs) and reused by all queries.
+    """
+    def __init__(self, zs, sq_norms=None):
+        self.zs = np.ascontiguousarray(zs, dtype=np.float32)
+        if sq_norms is None:
+            sq_norms = _sq_norms(self.zs)
+        self.sq_norms = np.asarray(sq_norms, dtype=np.float32)
+
+    def __len__(self):
+        return len(self.zs)
+
+    @classmethod
+    def load(cls, h5_path):
+        with h5py.File(h5_path, 'r') as hf:
+            zs = np.array(hf.get('zs'))
+            sq_norms = np.array(hf.get('sq_norms'))
+        print 'Encoded zs loaded from %s' % h5_path
+        return cls(zs, sq_norms)
+
+    def save(self, h5_path):
+        with h5py.File(h5_path, 'w') as hf:
+            hf.create_dataset('zs', data=self.zs)
+            hf.create_dataset('sq_norms', data=self.sq_norms)
+        print 'Encoded zs written to %s' % h5_path
+
+    def codes(self, idx):
+        return self.zs[idx]
+
+    def query(self, queries, k=1, block_size=4096):
+        """Return distances and indices of the k nearest zs, both [n, k].
+
+        Results are sorted by distance, nearest first.
+        """
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        return _blocked_knn(queries, self.zs, self.sq_norms, k, block_size)
+
+
+def _sq_dist(queries, query_sq_norms, zs, sq_norms):
+    """Squared distances [num_queries, len(zs)] with a single GEMM."""
+    dist = np.dot(queries, zs.T)
+    dist *= -2
+    dist += sq_norms
+    dist += query_sq_norms
+    return dist
+
+
+def _merge_topk(best_dist, best_idx, rows, dist, idx, k):
+    """Merge candidates (dist, idx) of rows into the running top-k in place.
+
+    best_dist, best_idx: [num_queries, k], filled with inf / -1 initially
+    dist: [len(rows), num_candidates], idx: [num_candidates]
+    """
+    cand_dist = np.hstack([best_dist[rows], dist])
+    cand_idx = np.hstack([best_idx[rows], np.tile(idx, (len(rows), 1))])
+    top = np.argpartition(cand_dist, k-1, axis=1)[:, :k]
+    sub_rows = np.arange(len(rows))[:, None]
+    best_dist[rows] = cand_dist[sub_rows, top]
+    best_idx[rows] = cand_idx[sub_rows, top]
+
+
+def _sorted_topk(best_dist, best_idx):
+    """Sort the top-k by distance and turn squared distances into distances."""
+    rows = np.arange(len(best_dist))[:, None]
+    order = np.argsort(best_dist, axis=1)
+    best_dist = np.sqrt(np.maximum(best_dist[rows, order], 0))
+    return best_dist, best_idx[rows, order]
+
+
+def _take_rows(data, rows):
+    """data[rows] for a numpy array or an h5 dataset, in the order of rows."""
+    if isinstance(data, np.ndarray):
+        return data[rows]
+    # h5py only reads increasing, unique indices
+    uniq, inverse = np.unique(rows, return_inverse=True)
+    if len(uniq) == 0:
+        return np.empty((0,) + data.shape[1:], dtype=data.dtype)
+    return data[uniq.tolist()][inverse]
+
+
+def _blocked_knn(queries, zs, sq_norms, k, block_size):
+    """Exact k-nn of queries among zs, return: distances, indices."""
+    num_queries = len(queries)
+    k = min(k, len(zs))
+    rows = np.arange(num_queries)
+    query_sq_norms = _sq_norms(queries)[:, None]
+    best_dist = np.full((num_queries, k), np.inf, dtype=np.float32)
+    best_idx = np.full((num_queries, k), -1, dtype=np.int64)
+    for b in range(0, len(zs), block_size):
+        dist = _sq_dist(queries, query_sq_norms,
+                        zs[b:b+block_size], sq_norms[b:b+block_size])
+        block_idx = np.arange(b, b + dist.shape[1])
+        _merge_topk(best_dist, best_idx, rows, dist, block_idx, k)
+    return _sorted_topk(best_dist, best_idx)
+
+
+def kmeans(zs, num_clusters, num_iters=20, seed=None, block_size=4096):
+    """Lloyd's k-means, assignments use the blocked exact search.
+
+    num_clusters is clamped to len(zs).
+    return: centroids [min(num_clusters, len(zs)), dim], assignments [len(zs)]
+    """
+    assert len(zs) > 0, 'kmeans needs at least one point'
+    num_clusters = min(num_clusters, len(zs))
+    rng = np.random.RandomState(seed)
+    centroids = zs[rng.choice(len(zs), num_clusters, replace=False)].copy()
+    for i in range(num_iters):
+        _, assign = _blocked_knn(
+            zs, centroids, _sq_norms(centroids), 1, block_size)
+        assign = assign[:, 0]
+        counts = np.bincount(assign, minlength=num_clusters)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, assign, zs)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        # restart empty clusters at random points
+        centroids[empty] = zs[rng.choice(len(zs), empty.sum(), replace=False)]
+    _, assign = _blocked_knn(zs, centroids, _sq_norms(centroids), 1, block_size)
+    return centroids, assign[:, 0]
+
+
+class IVFIndex(object):
+    """Approximate k-nn with an inverted file over k-means cells.
+
+    Codes are grouped by their nearest k-means centroid (one list per
+    centroid, stored contiguously). A query only scans the num_probe lists
+    whose centroids are closest to it; more probes trade speed for recall.
+    Returned indices refer to rows of the zs the index was built on.
+
+    list_zs and list_sq_norms are numpy arrays after build(), or the h5
+    datasets of the open file after load(), in which case only the probed
+    lists are read from disk. close() releases the file.
+    """
+    def __init__(self, centroids, list_zs, list_sq_norms, ids, offsets):
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.centroid_sq_norms = _sq_norms(self.centroids)
+        self.list_zs = list_zs
+        self.list_sq_norms = list_sq_norms
+        self._h5 = None
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.offsets = np.asarray(offsets, dtype=np.int64)
+        self.positions = np.empty_like(self.ids)
+        self.positions[self.ids] = np.arange(len(self.ids))
+
+    @property
+    def num_lists(self):
+        return len(self.centroids)
+
+    def __len__(self):
+        return len(self.ids)
+
+    @classmethod
+    def build(cls, zs, num_lists, num_iters=20, seed=None):
+        """num_lists is clamped to len(zs)."""
+        zs = np.ascontiguousarray(zs, dtype=np.float32)
+        centroids, assign = kmeans(zs, num_lists, num_iters, seed)
+        num_lists = len(centroids)
+        ids = np.argsort(assign, kind='mergesort')
+        counts = np.bincount(assign, minlength=num_lists)
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        list_zs = zs[ids]
+        return cls(centroids, list_zs, _sq_norms(list_zs), ids, offsets)
+
+    @classmethod
+    def load(cls, h5_path):
+        """Read centroids and ids, keep the lists on disk."""
+        hf = h5py.File(h5_path, 'r')
+        index = cls(np.array(hf.get('centroids')), hf['list_zs'],
+                    hf['list_sq_norms'], np.array(hf.get('ids')),
+                    np.array(hf.get('offsets')))
+        index._h5 = hf
+        print 'IVF index opened from %s' % h5_path
+        return index
+
+    def close(self):
+        if self._h5 is not None:
+            self._h5.close()
+            self._h5 = None
+
+    def save(self, h5_path):
+        with h5py.File(h5_path, 'w') as hf:
+            hf.create_dataset('centroids', data=self.centroids)
+            hf.create_dataset('list_zs', data=self.list_zs)
+            hf.create_dataset('list_sq_norms', data=self.list_sq_norms)
+            hf.create_dataset('ids', data=self.ids)
+            hf.create_dataset('offsets', data=self.offsets)
+        print 'IVF index written to %s' % h5_path
+
+    def codes(self, idx):
+        """Codes of valid indices, mask out the -1 returned by query first."""
+        idx = np.asarray(idx)
+        assert np.all(idx >= 0), 'codes() got -1 (no neighbour found)'
+        return _take_rows(self.list_zs, self.positions[idx])
+
+    def query(self, queries, k=1, num_probe=8):
+        """Return distances and indices of approx k nearest zs, both [n, k].
+
+        Queries are processed as a batch: every probed list is scanned once
+        with one GEMM against all queries that probe it. If the probed lists
+        hold fewer than k codes in total, the missing neighbours are returned
+        as distance inf and index -1.
+        """
+        queries = np.ascontiguousarray(queries, dtype=np.float32)
+        num_queries = len(queries)
+        num_probe = min(num_probe, self.num_lists)
+        query_sq_norms = _sq_norms(queries)[:, None]
+        _, probes = _blocked_knn(queries, self.centroids,
+                                 self.centroid_sq_norms, num_probe, 4096)
+
+        best_dist = np.full((num_queries, k), np.inf, dtype=np.float32)
+        best_idx = np.full((num_queries, k), -1, dtype=np.int64)
+        probe_rows = np.repeat(np.arange(num_queries), num_probe)
+        probe_lists = probes.ravel()
+        order = np.argsort(probe_lists, kind='mergesort')
+        probe_rows, probe_lists = probe_rows[order], probe_lists[order]
+        bounds = np.searchsorted(probe_lists, np.arange(self.num_lists + 1))
+        for l in range(self.num_lists):
+            begin, end = self.offsets[l], self.offsets[l+1]
+            rows = probe_rows[bounds[l]:bounds[l+1]]
+            if end == begin or len(rows) == 0:
+                continue
+            list_zs = np.asarray(self.list_zs[begin:end], dtype=np.float32)
+            list_sq_norms = np.asarray(self.list_sq_norms[begin:end],
+                                       dtype=np.float32)
+            dist = _sq_dist(queries[rows], query_sq_norms[rows],
+                            list_zs, list_sq_norms)
+            _merge_topk(best_dist, best_idx, rows, dist, self.ids[begin:end], k)
+        return _sorted_topk(best_dist, best_idx)
+
+
+def benchmark(index, exact_search, queries, k=1, num_probes=(1, 2, 4, 8, 16, 32),
+              min_recall=0.9, min_speedup=2.0):
+    """Print recall@k and time of index.query against exact search.
+
+    Ends with a verdict: the index is only worth using if some num_probe
+    is both clearly faster than exact search and has high recall.
+    """
+    t = time.time()
+    _, exact_idx = exact_search.query(queries, k)
+    exact_time = time.time() - t
+    print 'exact search: %.4fs for %d queries' % (exact_time, len(queries))
+    results = []
+    for num_probe in num_probes:
+        t = time.time()
+        _, idx = index.query(queries, k, num_probe)
+        ann_time = time.time() - t
+        hits = [len(np.intersect1d(a, e)) for a, e in zip(idx, exact_idx)]
+        recall = np.sum(hits) / float(exact_idx.size)
+        print '\tnum_probe: %d, recall@%d: %.4f, time: %.4fs, speedup: %.1fx' \
+            % (num_probe, k, recall, ann_time, exact_time / ann_time)
+        results.append((num_probe, recall, ann_time))
+    useful = [r for r in results
+              if r[1] >= min_recall and exact_time / r[2] >= min_speedup]
+    if useful:
+        num_probe, recall, ann_time = useful[0]
+        print 'IVF pays off: num_probe %d, recall %.4f at %.1fx speedup' \
+            % (num_probe, recall, exact_time / ann_time)
+    else:
+        best = max(exact_time / r[2] for r in results)
+        print 'IVF does not pay off here: no num_probe reaches recall %.2f' \
+            ' at %.1fx speedup (best speedup %.1fx), use exact search' \
+            % (min_recall, min_speedup, best)
+    return results
@@ -0,0 +1,142 @@
+"""Pure numpy RBM for cpu inference, no tensorflow/keras needed.
+
+Loads the h5 file written by RBM.save_model and mirrors the inference part
+of rbm.RBM: free_energy, compute_up/down, vhv and gibbs chains.
+"""
+import h5py
+import numpy as np
+
+
+def softplus(x, out=None):
+    """Stable impl of log(1 + e^x), same as utils.softplus."""
+    return np.logaddexp(0, x, out=out)
+
+
+def sigmoid(x, out=None):
+    """In place friendly sigmoid, out can be x itself."""
+    out = np.negative(x, out=out)
+    with np.errstate(over='ignore'):
+        np.exp(out, out=out)
+    out += 1
+    return np.reciprocal(out, out=out)
+
+
+class NumpyRBM(object):
+    """Numpy version of rbm.RBM for scoring and sampling.
+
+    dtype: storage and compute type of params, buffers and outputs.
+           np.float16 halves the memory, but numpy matmul on float16 does not
+           go through BLAS, so np.float32 is faster on cpu.
+    """
+    def __init__(self, weights, vbias, hbias, dtype=np.float32, seed=None):
+        self.dtype = np.dtype(dtype)
+        self.weights = np.ascontiguousarray(weights, dtype=self.dtype)
+        self.vbias = np.asarray(vbias, dtype=self.dtype).reshape(1, -1)
+        self.hbias = np.asarray(hbias, dtype=self.dtype).reshape(1, -1)
+        self.num_vis, self.num_hid = self.weights.shape
+        assert self.vbias.shape[1] == self.num_vis
+        assert self.hbias.shape[1] == self.num_hid
+        self.rng = np.random.RandomState(seed)
+        self._buffers = {}
+
+    @classmethod
+    def load(cls, params_file, dtype=np.float32, seed=None):
+        with h5py.File(params_file, 'r') as hf:
+            weights = np.array(hf.get('weights'))
+            vbias = np.array(hf.get('vbias'))
+            hbias = np.array(hf.get('hbias'))
+        return cls(weights, vbias, hbias, dtype, seed)
+
+    def _buffer(self, name, batch_size, dim):
+        """Return a scratch [batch_size, dim] buffer, grown on demand.
+
+        Scratch buffers are only used for intermediates, never returned.
+        """
+        buf = self._buffers.get(name)
+        if buf is None or buf.shape[0] < batch_size:
+            buf = np.empty((batch_size, dim), self.dtype)
+            self._buffers[name] = buf
+        return buf[:batch_size]
+
+    def _as_input(self, vis):
+        return np.ascontiguousarray(vis, dtype=self.dtype)
+
+    def h_total_input(self, vis, out=None):
+        vis = self._as_input(vis)
+        if out is None:
+            out = np.empty((len(vis), self.num_hid), self.dtype)
+        np.dot(vis, self.weights, out=out)
+        out += self.hbias
+        return out
+
+    def free_energy(self, vis):
+        """Compute the free energy defined on visibles.
+
+        return: free energy of shape: [batch_size]
+        """
+        vis = self._as_input(vis)
+        vbias_term = np.dot(vis, self.vbias[0])
+        h_total_input = self.h_total_input(
+            vis, self._buffer('hid', len(vis), self.num_hid))
+        sum_softplus = softplus(h_total_input, out=h_total_input).sum(axis=1)
+        return -vbias_term - sum_softplus
+
+    def compute_up(self, vis, out=None):
+        out = self.h_total_input(vis, out)
+        return sigmoid(out, out=out)
+
+    def compute_down(self, hid, out=None):
+        hid = self._as_input(hid)
+        if out is None:
+            out = np.empty((len(hid), self.num_vis), self.dtype)
+        np.dot(hid, self.weights.T, out=out)
+        out += self.vbias
+        return sigmoid(out, out=out)
+
+    def sample_bernoulli(self, ps, out=None):
+        if out is None:
+            out = np.empty(ps.shape, self.dtype)
+        return np.less(self.rng.random_sample(ps.shape), ps, out=out,
+                       casting='unsafe')
+
+    def reconstruct(self, vis, out=None):
+        """vprob of a mean-field up-down pass."""
+        hprob = self.compute_up(vis, self._buffer('hid', len(vis), self.num_hid))
+        return self.compute_down(hprob, out)
+
+    def vhv(self, vis_samples, vprob_out=None, vis_out=None):
+        """Same as RBM.vhv, returns vprob, vis_samples."""
+        hprob = self.compute_up(
+            vis_samples, self._buffer('hid', len(vis_samples), self.num_hid))
+        hid_samples = self.sample_bernoulli(hprob, out=hprob)
+        vprob = self.compute_down(hid_samples, vprob_out)
+        vis_samples = self.sample_bernoulli(vprob, vis_out)
+        return vprob, vis_samples
+
+    def gibbs(self, vis_samples, k):
+        """Run k >= 1 steps of vhv, reusing the output buffers across steps."""
+        assert k >= 1, 'gibbs needs at least one step, got k=%d' % k
+        batch_size = len(vis_samples)
+        vprob = np.empty((batch_size, self.num_vis), self.dtype)
+        samples = np.array(vis_samples, dtype=self.dtype)
+        for _ in range(k):
+            vprob, samples = self.vhv(samples, vprob, samples)
+        return vprob, samples
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+
+    t = time.time()
+    rbm = NumpyRBM.load(sys.argv[1])
+    print 'loaded %dx%d rbm in %.4fs' % (rbm.num_vis, rbm.num_hid, time.time() - t)
+
+    vis = rbm.rng.uniform(0, 1, (100, rbm.num_vis))
+    t = time.time()
+    fe = rbm.free_energy(vis)
+    print 'free energy of 100 random inputs: %.4f, %.4fs' \
+        % (fe.mean(), time.time() - t)
+    t = time.time()
+    vprob, _ = rbm.gibbs(vis, 100)
+    print '100 gibbs steps: %.4fs' % (time.time() - t)
@@ -0,0 +1,173 @@
+"""Log partition function of RBMs, computed with numpy on cpu.
+
+All functions take a np_rbm.NumpyRBM, e.g. NumpyRBM.load('epoch_500_rbm.h5').
+"""
+import multiprocessing
+from multiprocessing.pool import ThreadPool
+import numpy as np
+from np_rbm import softplus, sigmoid
+
+
+def _hidden_configs(start, stop, num_hid):
+    """Binary hidden configurations with index in [start, stop)."""
+    idx = np.arange(start, stop, dtype=np.int64)
+    return ((idx[:, None] >> np.arange(num_hid)) & 1).astype(np.float64)
+
+
+def hid_free_energy(weights, vbias, hbias, hid):
+    """Free energy defined on hiddens, -log sum_v exp(-E(v, h)).
+
+    Same terms as RBM.free_energy with the roles of vis and hid swapped.
+    return: free energy of shape: [batch_size]
+    """
+    hbias_term = np.dot(hid, hbias[0])
+    v_total_input = np.dot(hid, weights.T)
+    v_total_input += vbias
+    sum_softplus = softplus(v_total_input, out=v_total_input).sum(axis=1)
+    return -hbias_term - sum_softplus
+
+
+def logsumexp(xs):
+    max_x = np.max(xs)
+    return max_x + np.log(np.sum(np.exp(xs - max_x)))
+
+
+def exact_log_partition(rbm, chunk_size=2**14, num_threads=None):
+    """Exact log Z by enumerating all 2^num_hid hidden configurations.
+
+    Configurations are generated and reduced chunk by chunk, so at most
+    num_threads chunks of [chunk_size, num_vis] are alive at any time.
+    Chunks run on a thread pool, numpy BLAS calls release the GIL.
+    """
+    assert rbm.num_hid <= 32, \
+        'Cannot enumerate 2^%d hidden configurations.' % rbm.num_hid
+    # accumulate in float64 regardless of the storage type of rbm
+    weights = rbm.weights.astype(np.float64)
+    vbias = rbm.vbias.astype(np.float64)
+    hbias = rbm.hbias.astype(np.float64)
+    num_configs = 2 ** rbm.num_hid
+
+    def chunk_log_z(start):
+        hid = _hidden_configs(
+            start, min(start + chunk_size, num_configs), rbm.num_hid)
+        return logsumexp(-hid_free_energy(weights, vbias, hbias, hid))
+
+    if num_threads is None:
+        num_threads = multiprocessing.cpu_count()
+    pool = ThreadPool(num_threads)
+    try:
+        log_z = -np.inf
+        for chunk_val in pool.imap_unordered(
+                chunk_log_z, xrange(0, num_configs, chunk_size)):
+            log_z = np.logaddexp(log_z, chunk_val)
+    finally:
+        pool.close()
+        pool.join()
+    return log_z
+
+
+def log_likelihood(rbm, xs, log_z, batch_size=1000):
+    """Average log p(x) = -F(x) - log Z over xs."""
+    neg_fe = np.zeros(len(xs))
+    for b in xrange(0, len(xs), batch_size):
+        neg_fe[b:b+batch_size] = -rbm.free_energy(xs[b:b+batch_size])
+    return neg_fe.mean() - log_z
+
+
+def base_rate_vbias(xs, eps=1e-3):
+    """Visible biases of the base-rate model fitted to the data mean."""
+    mean = np.clip(np.mean(xs, axis=0), eps, 1 - eps)
+    return np.log(mean) - np.log(1 - mean)
+
+
+def default_betas():
+    """Standard schedule of 14500 intermediate distributions."""
+    return np.concatenate([np.linspace(0, 0.5, 500, endpoint=False),
+                           np.linspace(0.5, 0.9, 4000, endpoint=False),
+                           np.linspace(0.9, 1.0, 10001)])
+
+
+def ais_log_partition(rbm, num_runs=1000, betas=None, base_vbias=None, seed=None):
+    """Estimate log Z with annealed importance sampling.
+
+    Anneals from a base-rate model with visible biases base_vbias (no
+    hiddens) to rbm through p_k(v) ~ exp((1-b_k) * base_vbias.v) * p*_{b_k}(v),
+    where p*_b is the rbm with all params scaled by b. All num_runs runs
+    form one [num_runs, num_vis] batch, and one up-pass per step is shared
+    by the importance weights of both neighbouring betas and the transition.
+
+    return: log Z, (log Z - 3 std, log Z + 3 std)
+    """
+    rng = np.random.RandomState(seed)
+    if betas is None:
+        betas = default_betas()
+    if base_vbias is None:
+        base_vbias = np.zeros(rbm.num_vis)
+    base_vbias = np.asarray(base_vbias, dtype=rbm.dtype).reshape(1, -1)
+    log_z_base = (softplus(base_vbias.astype(np.float64)).sum()
+                  + rbm.num_hid * np.log(2))
+
+    def unnormalized_log_prob(base_term, vbias_term, h_total_input, beta_pair):
+        """log p*_b(v) for the two betas at once, [2, num_runs].
+
+        Computed in float64 since the weights are differences of large terms.
+        """
+        betas_3d = beta_pair.reshape(-1, 1, 1)
+        sum_softplus = softplus(betas_3d * h_total_input).sum(axis=2)
+        return ((1 - beta_pair)[:, None] * base_term
+                + beta_pair[:, None] * vbias_term + sum_softplus)
+
+    vprob = np.tile(sigmoid(base_vbias), (num_runs, 1))
+    vis = (rng.random_sample(vprob.shape) < vprob).astype(rbm.dtype)
+    log_weights = np.zeros(num_runs)
+    for beta_prev, beta in zip(betas[:-1], betas[1:]):
+        h_total_input = rbm.h_total_input(vis)
+        base_term = np.dot(vis, base_vbias[0])
+        vbias_term = np.dot(vis, rbm.vbias[0])
+        log_probs = unnormalized_log_prob(
+            base_term, vbias_term, h_total_input,
+            np.array([beta, beta_prev], dtype=np.float64))
+        log_weights += log_probs[0] - log_probs[1]
+
+        # transition that keeps p_beta invariant
+        hprob = sigmoid(beta * h_total_input)
+        hid = (rng.random_sample(hprob.shape) < hprob).astype(rbm.dtype)
+        v_total_input = beta * (np.dot(hid, rbm.weights.T) + rbm.vbias)
+        v_total_input += (1 - beta) * base_vbias
+        vprob = sigmoid(v_total_input)
+        vis = (rng.random_sample(vprob.shape) < vprob).astype(rbm.dtype)
+
+    log_mean_weight = logsumexp(log_weights) - np.log(num_runs)
+    log_z = log_z_base + log_mean_weight
+    # bounds from mean weight +- 3 std, relative to the mean weight
+    weights = np.exp(log_weights - log_mean_weight)
+    delta = 3 * np.std(weights) / np.sqrt(num_runs)
+    log_z_low = log_z + np.log(max(1 - delta, 1e-12))
+    log_z_high = log_z + np.log(1 + delta)
+    return log_z, (log_z_low, log_z_high)
+
+
+if __name__ == '__main__':
+    import sys
+    import time
+    import h5py
+    from np_rbm import NumpyRBM
+
+    rbm = NumpyRBM.load(sys.argv[1])
+    t = time.time()
+    if len(sys.argv) < 3:
+        log_z = exact_log_partition(rbm)
+        print 'exact log Z of %dx%d rbm: %.6f' % (rbm.num_vis, rbm.num_hid, log_z)
+        print '\tTime Taken: %ss' % (time.time() - t)
+        sys.exit()
+
+    # second arg: dataset h5 written by DatasetWrapper.dump_to_h5
+    with h5py.File(sys.argv[2], 'r') as hf:
+        train_xs = np.array(hf.get('train_xs'))
+        test_xs = np.array(hf.get('test_xs'))
+    log_z, (log_z_low, log_z_high) = ais_log_partition(
+        rbm, base_vbias=base_rate_vbias(train_xs), seed=666)
+    print 'ais log Z of %dx%d rbm: %.4f, 3 std: (%.4f, %.4f)' \
+        % (rbm.num_vis, rbm.num_hid, log_z, log_z_low, log_z_high)
+    print 'test log likelihood: %.4f' % log_likelihood(rbm, test_xs, log_z)
+    print '\tTime Taken: %ss' % (time.time() - t)
@@ -16,6 +16,8 @@ import stl_ae
 import utils
 
 
+PT_BETAS = np.linspace(1.0, 0.5, 8)
+
 TRAIN_SCHEMES = {
     'ptrbm_scheme0': {
         'num_hid': 2000,
@@ -51,6 +53,22 @@ TRAIN_SCHEMES = {
             TrainConfig(
                 lr=0.001, batch_size=100, num_epoch=500, use_pcd=True, cd_k=25),
         ]},
+    # scheme1 with parallel tempering instead of long pcd chains
+    'ptrbm_scheme2': {
+        'num_hid': 2000,
+        'force_retrain': True,
+        'train_configs':[
+            TrainConfig(
+                lr=0.1, batch_size=100, num_epoch=100, use_pcd=False, cd_k=1),
+            TrainConfig(
+                lr=0.05, batch_size=100, num_epoch=100, use_pcd=False, cd_k=5),
+            TrainConfig(
+                lr=0.005, batch_size=100, num_epoch=500, use_pcd=True, cd_k=1,
+                pt_betas=PT_BETAS),
+            TrainConfig(
+                lr=0.002, batch_size=100, num_epoch=500, use_pcd=True, cd_k=5,
+                pt_betas=PT_BETAS),
+        ]},
 }
 
 
@@ -91,7 +109,11 @@ if __name__ == '__main__':
     output_folder = os.path.join(
         ae_folder, name+('_%d_bird'%TRAIN_SCHEMES[name]['num_hid']))
 
-    if os.path.exists(output_folder) and not scheme['force_retrain']:
+    # an interrupted scheme resumes from its checkpoint unless force_retrain
+    checkpoint_path = os.path.join(output_folder, 'checkpoint.h5')
+    resume = not scheme['force_retrain']
+    if (os.path.exists(output_folder) and resume
+        and not os.path.exists(checkpoint_path)):
         print '%s exists, skip training.' % name
         exit()
 
@@ -99,7 +121,8 @@ if __name__ == '__main__':
     rbm = RBM(encoded_dataset.x_shape[0], scheme['num_hid'], None)
     train_configs = scheme['train_configs']
     utils.log_train_configs(train_configs, output_folder)
-    for config in train_configs:
-        rbm_dir = pretrain(sess, rbm, encoded_dataset, ae.decoder,
-                           config, utils.vis_cifar10, output_folder)
-        # rbm.save_model(sess, rbm_dir, 'epoch_%d_' % config.num_epoch)
+    rbm_dirs = pretrain(sess, rbm, encoded_dataset, ae.decoder,
+                        train_configs, utils.vis_cifar10, output_folder,
+                        checkpoint_path, resume)
+    # for rbm_dir, config in zip(rbm_dirs, train_configs):
+    #     rbm.save_model(sess, rbm_dir, 'epoch_%d_' % config.num_epoch)
@@ -6,7 +6,14 @@ import utils
 
 
 class RBM(object):
-    def __init__(self, num_vis, num_hid, params_file):
+    def __init__(self, num_vis, num_hid, params_file, up_scale=1.0, down_scale=1.0):
+        """up_scale, down_scale: multiply the weights of the up / down pass
+        of sampling, 2 for the bottom / top RBM of a DBM stack (see
+        dbm_pretrain). The energy, and so the free energy and the cost,
+        always uses the plain weights.
+        """
+        self.up_scale = up_scale
+        self.down_scale = down_scale
         if not params_file:
             assert num_vis and num_hid
             self.num_vis = num_vis
@@ -34,52 +41,98 @@ class RBM(object):
             hf.create_dataset('vbias', data=vbias)
             hf.create_dataset('hbias', data=hbias)
 
-    def sparsity_cost(self, vis):
+    def h_total_input(self, vis):
+        """Pre-activation of hiddens under the energy, shared by all
+        up-pass computations, see _up_input for the sampling pass.
+        """
+        return tf.matmul(vis, self.weights) + self.hbias
+
+    def _up_input(self, h_total_input):
+        """Pre-activation of hiddens in the up pass, with up_scale applied."""
+        if self.up_scale != 1.0:
+            return self.up_scale * (h_total_input - self.hbias) + self.hbias
+        return h_total_input
+
+    def sparsity_cost(self, vis, h_total_input=None):
+        if h_total_input is None:
+            h_total_input = self.h_total_input(vis)
         p_target = tf.constant(0.01, dtype=tf.float32, shape=[1, self.num_hid])
-        h_total_input = tf.matmul(vis, self.weights) + self.hbias
         penalty = (- tf.matmul(p_target, h_total_input, transpose_b=True)
                    + tf.reduce_sum(utils.softplus(h_total_input), 1))
         return tf.reduce_mean(penalty)
 
-    def free_energy(self, vis_samples):
+    def free_energy(self, vis_samples, h_total_input=None):
         """Compute the free energy defined on visibles.
 
+        h_total_input: precomputed h_total_input(vis_samples), optional
         return: free energy of shape: [batch_size, 1]
         """
+        if h_total_input is None:
+            h_total_input = self.h_total_input(vis_samples)
         vbias_term = tf.matmul(vis_samples, self.vbias, transpose_b=True)
         vbias_term = tf.reshape(vbias_term, [-1]) # flattern
-        h_total_input = tf.matmul(vis_samples, self.weights) + self.hbias
         softplus_term = utils.softplus(h_total_input)
         sum_softplus = tf.reduce_sum(softplus_term, 1)
         return -vbias_term - sum_softplus
 
-    def vhv(self, vis_samples):
-        hid_samples = utils.sample_bernoulli(self._compute_up(vis_samples))
+    def vhv(self, vis_samples, h_total_input=None):
+        hprob = self._compute_up(vis_samples, h_total_input)
+        hid_samples = utils.sample_bernoulli(hprob)
         vprob = self._compute_down(hid_samples)
         vis_samples = utils.sample_bernoulli(vprob)
         return vprob, vis_samples
 
+    def _cd_energy(self, vis, h_total_input):
+        """Surrogate of the free energy whose gradients are the statistics
+        of the sampling passes: -v hprob for weights, -hprob for hbias and
+        -v for vbias, with hprob = _compute_up(vis), so up_scale included.
+
+        Same as free_energy without scales. With up_scale / down_scale the
+        gradient stays the CD update of the doubled RBMs of Salakhutdinov &
+        Hinton, down_scale acts through the model visibles it samples.
+        return: [batch_size]
+        """
+        hprob = tf.stop_gradient(self._compute_up(vis, h_total_input))
+        vbias_term = tf.reshape(
+            tf.matmul(vis, self.vbias, transpose_b=True), [-1])
+        return -vbias_term - tf.reduce_sum(hprob * h_total_input, 1)
+
+    def cd_cost(self, vis_data, vis_model, h_data=None, h_model=None):
+        """Cost whose gradient is <v hprob>_model - <v hprob>_data."""
+        if h_data is None:
+            h_data = self.h_total_input(vis_data)
+        if h_model is None:
+            h_model = self.h_total_input(vis_model)
+        return (tf.reduce_mean(self._cd_energy(vis_data, h_data))
+                - tf.reduce_mean(self._cd_energy(vis_model, h_model)))
+
     def loss_and_cost(self, vis_data, vis_model):
-        cost = (tf.reduce_mean(self.free_energy(vis_data))
-                - tf.reduce_mean(self.free_energy(vis_model)))
-        sparsity_penalty = 0.5 * (self.sparsity_cost(vis_data)
-                                  + self.sparsity_cost(vis_model))
+        # one up-pass per input, shared by cost, sparsity and loss
+        h_data = self.h_total_input(vis_data)
+        h_model = self.h_total_input(vis_model)
+        cost = self.cd_cost(vis_data, vis_model, h_data, h_model)
+        sparsity_penalty = 0.5 * (self.sparsity_cost(vis_data, h_data)
+                                  + self.sparsity_cost(vis_model, h_model))
         # sparsity_penalty = tf.Print(sparsity_penalty, [sparsity_penalty])
-        loss = self._l2_loss_function(vis_data)
+        loss = self._l2_loss_function(vis_data, h_data)
         return loss, cost + 0.1 * sparsity_penalty
 
-    def _compute_up(self, vis):
-        hprob = tf.nn.sigmoid(tf.matmul(vis, self.weights) + self.hbias)
+    def _compute_up(self, vis, h_total_input=None):
+        if h_total_input is None:
+            h_total_input = self.h_total_input(vis)
+        hprob = tf.nn.sigmoid(self._up_input(h_total_input))
         # hprob = tf.Print(hprob, [tf.reduce_mean(hprob)])
         return hprob
 
     def _compute_down(self, hid):
-        vprob = tf.nn.sigmoid(
-            tf.matmul(hid, self.weights, transpose_b=True) + self.vbias)
+        v_total_input = tf.matmul(hid, self.weights, transpose_b=True)
+        if self.down_scale != 1.0:
+            v_total_input = self.down_scale * v_total_input
+        vprob = tf.nn.sigmoid(v_total_input + self.vbias)
         return vprob
 
-    def _l2_loss_function(self, vis):
-        recon_vprob, _ = self.vhv(vis)
+    def _l2_loss_function(self, vis, h_total_input=None):
+        recon_vprob, _ = self.vhv(vis, h_total_input)
         num_dims = vis.get_shape().ndims
         dims = range(num_dims)
         instance_loss = tf.reduce_sum(tf.square(vis - recon_vprob), dims[1:])
@@ -117,3 +170,33 @@ class RBM(object):
 #         vis_mean = self._compute_down(hid_samples)
 #         vis_samples = self.sample_gaussian(vis_mean)
 #         return vis_mean, vis_samples
+
+
+# test =================
+def cd_gradient_check(up_scale=2.0, down_scale=2.0):
+    """Check that -dcost/dW = <v hprob>_data - <v hprob>_model, where
+    hprob is the up pass of sampling, with up_scale applied.
+    """
+    np.random.seed(666)
+    num_vis, num_hid, batch_size = 6, 4, 10
+    with tf.Graph().as_default():
+        rbm = RBM(num_vis, num_hid, None, up_scale, down_scale)
+        vis_data = tf.constant(
+            np.random.binomial(1, 0.5, (batch_size, num_vis)), tf.float32)
+        vis_model = tf.constant(
+            np.random.binomial(1, 0.5, (batch_size, num_vis)), tf.float32)
+        grad_w = tf.gradients(rbm.cd_cost(vis_data, vis_model), rbm.weights)[0]
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            grad_w, v_data, v_model, h_data, h_model = sess.run(
+                [grad_w, vis_data, vis_model,
+                 rbm._compute_up(vis_data), rbm._compute_up(vis_model)])
+    expected = (np.dot(v_data.T, h_data) - np.dot(v_model.T, h_model)) / batch_size
+    assert np.allclose(-grad_w, expected, atol=1e-5), np.abs(grad_w + expected).max()
+    print 'cd gradient with up_scale %s, down_scale %s: ok' % (up_scale, down_scale)
+
+
+if __name__ == '__main__':
+    cd_gradient_check(1.0, 1.0)
+    cd_gradient_check(2.0, 1.0)
+    cd_gradient_check(1.0, 2.0)
@@ -27,29 +27,68 @@ class RBMPretrainer(RBMTrainer):
         super(RBMPretrainer, self)._save_samples(samples, img_path)
 
 
-def pretrain(sess, rbm, dataset, decoder, train_config, vis_fn, parent_dir):
-    if train_config.use_pcd:
-        sampler = gibbs_sampler.GibbsSampler.create_pcd_sampler(
-            rbm, train_config.batch_size, train_config.cd_k)
+def _train_sampler(rbm, train_config):
+    if train_config.pt_betas is not None:
+        return gibbs_sampler.ParallelTemperingSampler.create_pcd_sampler(
+            rbm, train_config.batch_size, train_config.cd_k,
+            train_config.pt_betas, loop=True)
+    elif train_config.use_pcd:
+        return gibbs_sampler.GibbsSampler.create_pcd_sampler(
+            rbm, train_config.batch_size, train_config.cd_k, loop=True)
     else:
-        sampler = gibbs_sampler.GibbsSampler.create_cd_sampler(
-            rbm, train_config.cd_k)
+        return gibbs_sampler.GibbsSampler.create_cd_sampler(
+            rbm, train_config.cd_k, loop=True)
 
+
+def _sampler_generator(rbm, dataset, train_config):
     if train_config.draw_samples:
-        sampler_generator = gibbs_sampler.create_sampler_generator(
-            rbm, None, 100, 1000)
+        return gibbs_sampler.create_sampler_generator(
+            rbm, None, 100, 1000, train_config.pt_betas)
     else:
-        sampler_generator = gibbs_sampler.create_sampler_generator(
+        return gibbs_sampler.create_sampler_generator(
             rbm, dataset.test_xs[:100], None, 0)
 
-    rbm_dir = 'ptrbm_hid%d_%s' % (rbm.num_hid, str(train_config))
-    output_dir = os.path.join(parent_dir, rbm_dir)
-    train_config.dump_log(output_dir)
 
-    trainer = RBMPretrainer(sess, dataset, rbm, decoder, vis_fn, output_dir)
-    trainer.train(train_config, sampler, sampler_generator)
-    trainer.dump_log(output_dir)
-    return output_dir
+def pretrain(sess, rbm, dataset, decoder, train_configs, vis_fn, parent_dir,
+             checkpoint_path=None, resume=True):
+    """Train rbm with a schedule of train_configs, one folder per stage.
+
+    The looped samplers and the training graph are built once per kind of
+    sampler (cd, pcd or pt, and batch size) and shared by all stages of
+    that kind, every stage feeds its own cd_k and lr. The pcd chains of a
+    stage therefore continue from the previous pcd stage.
+    checkpoint_path, resume: see RBMTrainer.train, one checkpoint holds
+                             the progress through the whole schedule
+    return: output folder of every stage
+    """
+    trainer = RBMPretrainer(sess, dataset, rbm, decoder, vis_fn, None)
+    samplers = {}
+    sampler_generators = {}
+    output_dirs = []
+    for stage, train_config in enumerate(train_configs):
+        sampler_key = (train_config.use_pcd, train_config.batch_size,
+                       utils.betas_key(train_config.pt_betas))
+        if sampler_key not in samplers:
+            samplers[sampler_key] = _train_sampler(rbm, train_config)
+        generator_key = (train_config.draw_samples,
+                         utils.betas_key(train_config.pt_betas))
+        if generator_key not in sampler_generators:
+            sampler_generators[generator_key] = _sampler_generator(
+                rbm, dataset, train_config)
+
+        rbm_dir = 'ptrbm_hid%d_%s' % (rbm.num_hid, str(train_config))
+        output_dir = os.path.join(parent_dir, rbm_dir)
+        train_config.dump_log(output_dir)
+
+        trainer.set_output_dir(output_dir)
+        trainer.log = []
+        trainer.train(train_config, samplers[sampler_key],
+                      sampler_generators[generator_key],
+                      checkpoint_path=checkpoint_path, stage=stage, resume=resume)
+        if trainer.log: # empty if the stage was skipped on resume
+            trainer.dump_log(output_dir)
+        output_dirs.append(output_dir)
+    return output_dirs
 
 
 if __name__ == '__main__':
@@ -81,7 +120,7 @@ if __name__ == '__main__':
         lr=0.01, batch_size=100, num_epoch=200, use_pcd=True, cd_k=5)
 
     pretrain(sess, rbm, encoded_dataset, ae.decoder,
-             train_config, utils.vis_cifar10, output_folder)
+             [train_config], utils.vis_cifar10, output_folder)
 
     # utils.initialize_uninitialized_variables_by_keras()
     # h = sess.run(rbm._compute_up(encoded_dataset.test_xs))
@@ -1,9 +1,11 @@
 import os
-import math
 import time
 import numpy as np
 import tensorflow as tf
 import utils
+import checkpoint
+import diagnostics
+from dataset_wrapper import MinibatchIterator
 
 
 class RBMTrainer(object):
@@ -13,6 +15,10 @@ class RBMTrainer(object):
         self.vis_fn = vis_fn
         self.sess = sess
         self.log = []
+        self.set_output_dir(output_dir)
+        self._train_ops = {}
+
+    def set_output_dir(self, output_dir):
         self.output_dir = output_dir
         if output_dir and not os.path.exists(output_dir):
             os.makedirs(output_dir)
@@ -21,54 +27,146 @@ class RBMTrainer(object):
     def x_shape(self):
         return [None] + list(self.dataset.x_shape)
 
-    def train(self, train_config, sampler, sampler_generator):
-        # define graph
+    def _build_train_ops(self, sampler):
+        """Build the training graph for sampler, once per sampler.
+
+        The learning rate is fed, so stages of a schedule that share a
+        sampler also share this graph.
+        """
+        if sampler in self._train_ops:
+            return self._train_ops[sampler]
+
         x_data_node = tf.placeholder(tf.float32, self.x_shape)
-        x_model_node = tf.placeholder(tf.float32, self.x_shape)
-        loss, cost = self.rbm.loss_and_cost(x_data_node, x_model_node)
-        opt = tf.train.GradientDescentOptimizer(train_config.lr)
-        train_step = opt.minimize(cost)
+        lr_node = tf.placeholder(tf.float32, [], name='lr')
         # define sampler graph
         if sampler.is_persistent:
-            print '>>> train with pcd'
             sample_op, sampler_updates = sampler.sample()
         else:
-            print '>>> train with cd'
             sample_op, sampler_updates = sampler.sample(x_data_node)
+        # treat negative samples as constant during gradient comp
+        x_model_node = tf.stop_gradient(sample_op)
 
-        # prevent tf.init from resetting encoder
-        utils.initialize_uninitialized_variables_by_keras()
-
+        loss, cost = self.rbm.loss_and_cost(x_data_node, x_model_node)
         fe_x_data_op = tf.reduce_mean(self.rbm.free_energy(x_data_node))
         fe_x_model_op = tf.reduce_mean(self.rbm.free_energy(x_model_node))
+        # mixing of the persistent chain, traced at the monitored batches
+        trace_stats = {}
+        if sampler.is_persistent:
+            trace_stats = diagnostics.rbm_chain_stats(self.rbm, x_model_node)
+
+        opt = tf.train.GradientDescentOptimizer(lr_node)
+        grads_and_vars = opt.compute_gradients(cost)
+        # read monitors before params are updated within the same run
+        with tf.control_dependencies([loss]):
+            train_step = opt.apply_gradients(grads_and_vars)
+        with tf.control_dependencies(
+                [loss, fe_x_data_op, fe_x_model_op] + trace_stats.values()):
+            monitored_train_step = opt.apply_gradients(grads_and_vars)
+
+        ops = {'x_data': x_data_node, 'lr': lr_node, 'loss': loss,
+               'train_step': train_step,
+               'monitored_train_step': monitored_train_step,
+               'sampler_updates': sampler_updates,
+               'fe_x_data': fe_x_data_op, 'fe_x_model': fe_x_model_op,
+               'trace_stats': trace_stats, 'optimizer': opt}
+        self._train_ops[sampler] = ops
+        return ops
+
+    def train(self, train_config, sampler, sampler_generator,
+              monitor_freq=10, prefetch=False, checkpoint_path=None,
+              checkpoint_freq=10, stage=0, resume=True):
+        """Train the rbm with one fused session run per minibatch.
+
+        The negative samples never leave the graph: the sampler output feeds
+        the cost directly and the chain update runs with the parameter update.
+        The graph is built on the first call with a sampler and reused by
+        later calls with the same sampler, a looped sampler then runs with
+        the cd_k of train_config.
+        monitor_freq: compute FE_data/FE_model every monitor_freq batches,
+                      and with a persistent sampler record chain stats for
+                      diagnostics.TraceRecorder, reported every epoch;
+                      ess/sec counts the whole training time, the chain
+                      runs inside the fused training step
+        prefetch: gather the next minibatch in a background thread
+        checkpoint_path: h5 written in the background every checkpoint_freq
+                         epochs with params, chains, optimizer slots, epoch,
+                         log and np rng
+        stage: index of train_config in a schedule of TrainConfig; with
+               resume, a checkpoint of a later stage skips this one and a
+               checkpoint of this stage continues from its epoch
+        """
+        ops = self._build_train_ops(sampler)
+        x_data_node = ops['x_data']
+        # prevent tf.init from resetting encoder
+        utils.initialize_uninitialized_variables_by_keras()
 
-        train_xs = self.dataset.train_xs
-        num_batches = int(math.ceil(len(train_xs) / float(train_config.batch_size)))
-
-        fe_x_data = np.zeros(num_batches)
-        fe_x_model = np.zeros(num_batches)
-
-        for e in range(train_config.num_epoch):
+        ckpt = None
+        start_epoch = 0
+        if checkpoint_path:
+            ckpt = checkpoint.TrainingCheckpoint(
+                self.sess, checkpoint_path,
+                self._checkpoint_vars(sampler, ops['optimizer'], stage))
+            if resume and ckpt.exists():
+                ckpt_stage, _ = ckpt.progress()
+                if ckpt_stage > stage:
+                    print 'Stage %d already done in %s, skip.' % (stage, checkpoint_path)
+                    ckpt.close()
+                    return
+                if ckpt_stage == stage:
+                    _, start_epoch, self.log = ckpt.restore()
+
+        # shuffles an index, self.dataset.train_xs is never reordered
+        batches = MinibatchIterator(
+            self.dataset.train_xs, train_config.batch_size, prefetch=prefetch)
+        num_batches = len(batches)
+        if sampler.loop:
+            sampler.cd_k = train_config.cd_k
+        else:
+            assert sampler.cd_k == train_config.cd_k, 'unrolled chain, fixed cd_k.'
+        print '>>> train with %s-%d' % (
+            'pcd' if sampler.is_persistent else 'cd', train_config.cd_k)
+        static_feed = {ops['lr']: train_config.lr}
+        static_feed.update(sampler.feed_dict())
+        loss = ops['loss']
+        sampler_updates = ops['sampler_updates']
+        trace = diagnostics.TraceRecorder(ops['trace_stats'])
+
+        for e in range(start_epoch, train_config.num_epoch):
             t = time.time()
-            np.random.shuffle(train_xs)
             loss_vals = np.zeros(num_batches)
-            for b in range(num_batches):
-                x_data = train_xs[b * train_config.batch_size
-                                  :(b+1) * train_config.batch_size]
-                feed_dict = {} if sampler.is_persistent else {x_data_node: x_data}
-                x_model, _ = self.sess.run([sample_op, sampler_updates], feed_dict)
-                feed_dict = {x_data_node: x_data, x_model_node: x_model}
-                loss_vals[b], _ = self.sess.run([loss, train_step], feed_dict)
-
-                fe_x_data[b], fe_x_model[b] = self.sess.run(
-                    [fe_x_data_op, fe_x_model_op], feed_dict)
+            fe_x_data = []
+            fe_x_model = []
+            trace.reset()
+            trace_t = t
+            for b, x_data in enumerate(batches):
+                feed_dict = {x_data_node: x_data}
+                feed_dict.update(static_feed)
+                if monitor_freq and b % monitor_freq == 0:
+                    loss_vals[b], _, _, fe_data, fe_model, stat_vals \
+                        = self.sess.run(
+                            [loss, ops['monitored_train_step'], sampler_updates,
+                             ops['fe_x_data'], ops['fe_x_model'], trace.fetches],
+                            feed_dict)
+                    fe_x_data.append(fe_data)
+                    fe_x_model.append(fe_model)
+                    if trace.names:
+                        trace.append(stat_vals, time.time() - trace_t)
+                        trace_t = time.time()
+                else:
+                    loss_vals[b], _, _ = self.sess.run(
+                        [loss, ops['train_step'], sampler_updates], feed_dict)
 
             self.log.append('Epoch %d, Train Loss: %.4f' % (e+1, loss_vals.mean()))
             print self.log[-1]
             print '\tTime Taken: %ss' % (time.time() - t)
-            print '\tFE_data: %s, FE_model: %s' % (fe_x_data.mean(), fe_x_model.mean())
-
-            if (e+1) % 10 == 0 and self.output_dir:
+            if fe_x_data:
+                print '\tFE_data: %s, FE_model: %s' \
+                    % (np.mean(fe_x_data), np.mean(fe_x_model))
+            if trace.names:
+                trace.report()
+
+            # nothing to plot without vis_fn, skip the costly draw
+            if (e+1) % 10 == 0 and self.output_dir and self.vis_fn is not None:
                 samples = self._draw_samples(sampler_generator())
                 samples_path = os.path.join(
                     self.output_dir, 'samples-epoch%d.png' % (e+1))
@@ -76,6 +174,22 @@ class RBMTrainer(object):
             if (e+1) % 100 == 0 and self.output_dir:
                 self.rbm.save_model(self.sess, self.output_dir, 'epoch_%d_' % (e+1))
                 self.dump_log()
+            if ckpt and ((e+1) % checkpoint_freq == 0
+                         or e+1 == train_config.num_epoch):
+                ckpt.save(stage, e+1, self.log)
+        if ckpt:
+            ckpt.close()
+
+    def _checkpoint_vars(self, sampler, optimizer, stage):
+        """Variables of the training state, keyed independent of tf names."""
+        params = {'rbm/weights': self.rbm.weights,
+                  'rbm/vbias': self.rbm.vbias,
+                  'rbm/hbias': self.rbm.hbias}
+        variables = dict(params)
+        if sampler.is_persistent:
+            variables['rbm/pcd_chain_stage%d' % stage] = sampler.samples
+        variables.update(checkpoint.optimizer_slots(optimizer, params))
+        return variables
 
     def dump_log(self, output_dir=None):
         if output_dir is None:
@@ -86,21 +200,17 @@ class RBMTrainer(object):
             f.write('\n')
 
     def _draw_samples(self, sampler):
-        """Use a new sampler to draw samples from the trained model.
+        """Reseed the reusable sampler and draw samples from the trained model.
         """
         assert sampler.is_persistent
-        utils.initialize_uninitialized_variables_by_keras()
-
-        sample_op, sampler_updates = sampler.sample()
-        for _ in range(sampler.burnin):
-            self.sess.run([sample_op, sampler_updates])
-
-        samples, _ = self.sess.run([sample_op, sampler_updates])
+        samples = sampler.draw(self.sess)
         print 'in _draw_samples: samples min: %.4f, max: %.4f' \
             % (samples.min(), samples.max())
         return samples
 
     def _save_samples(self, samples, img_path):
+        if self.vis_fn is None:
+            return
         batch_size = len(samples)
         rows, cols = utils.factorize_number(batch_size)
         self.vis_fn(samples, rows, cols, img_path)
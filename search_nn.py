@@ -1,23 +1,51 @@
-from dem import DEM
+import os
 import numpy as np
+from dem import DEM
+from knn import ExactSearch, IVFIndex
+import knn
+
+
+def load_or_encode_zs(encoder, xs, cache_path=None):
+    """Return an ExactSearch over encoder(xs), cached at cache_path if given.
+
+    With an existing cache_path, encoder.predict is skipped entirely.
+    """
+    if cache_path and os.path.exists(cache_path):
+        return ExactSearch.load(cache_path)
+    search = ExactSearch(encoder.predict(xs))
+    if cache_path:
+        search.save(cache_path)
+    return search
+
+
+def load_or_build_index(search, index_path=None, num_lists=256, num_iters=20):
+    """Return an IVFIndex over the zs of search, cached at index_path.
+
+    Build it once per encoder checkpoint, e.g. next to the zs cache.
+    """
+    if index_path and os.path.exists(index_path):
+        return IVFIndex.load(index_path)
+    index = IVFIndex.build(search.zs, num_lists, num_iters, seed=666)
+    if index_path:
+        index.save(index_path)
+    return index
+
 
+def find_nearest_z_data(encoder, xs, z_sample, cache_path=None, search=None):
+    """For each z_sample, find the nearest encoded training data.
 
-def find_nearest_z_data(encoder, xs, z_sample):
-    zs = encoder.predict(xs)
-    z_data = np.zeros_like(z_sample)
-    zz_distance = np.zeros(len(z_sample))
-    for i in range(len(z_sample)):
-        z_ref = z_sample[i]
-        min_dis = float('inf')
-        z_target = None
-        for z in zs:
-            dis = np.linalg.norm(z_ref-z)
-            if dis < min_dis:
-                z_target = z
-                min_dis = dis
-        zz_distance[i] = min_dis
-        z_data[i] = z_target
-    return z_data, zz_distance
+    search: prebuilt ExactSearch or IVFIndex over encoder(xs), overrides
+            encoder/xs
+    return: nearest z_data, distances, rows without a neighbour are nan, inf
+    """
+    if search is None:
+        search = load_or_encode_zs(encoder, xs, cache_path)
+    zz_distance, idx = search.query(z_sample, k=1)
+    # an IVFIndex returns -1 when no probed list had a candidate
+    found = idx[:, 0] >= 0
+    z_data = np.full(z_sample.shape, np.nan, dtype=np.float32)
+    z_data[found] = search.codes(idx[found, 0])
+    return z_data, zz_distance[:, 0]
 
 
 if __name__ == '__main__':
@@ -55,11 +83,18 @@ if __name__ == '__main__':
                                     rbm_params_file)
     sampler_generator = gibbs_sampler.create_sampler_generator(
         dem.rbm, None, 64, 10000)
+    utils.initialize_uninitialized_variables_by_keras()
     output_dir = encoder_weights_file.rsplit('/', 1)[0]
     dem_trainer = DEMTrainer(sess, dataset, dem, utils.vis_cifar10, output_dir)
 
     z_sample = dem_trainer._draw_samples(sampler_generator())
-    z_data, distance = find_nearest_z_data(dem.encoder, dataset.train_xs, z_sample)
+    exact_search = load_or_encode_zs(
+        dem.encoder, dataset.train_xs, encoder_weights_file+'.train_zs.h5')
+    index = load_or_build_index(
+        exact_search, encoder_weights_file+'.train_zs_ivf.h5')
+    knn.benchmark(index, exact_search, z_sample, k=10)
+    z_data, distance = find_nearest_z_data(
+        None, None, z_sample, search=exact_search)
     dem_trainer._save_samples(z_sample, encoder_weights_file+'.z_sample.png')
     dem_trainer._save_samples(z_data, encoder_weights_file+'.z_data.png')
     with open(encoder_weights_file+'.zz_distance.txt', 'w') as f:
@@ -16,16 +16,23 @@ STL10_COLOR_STD_RGB = np.array([ 68.5,  66.6,  68.5]).reshape(1, 1, 3)
 
 
 class TrainConfig(object):
-    def __init__(self, lr, batch_size, num_epoch, use_pcd, cd_k):
+    """pt_betas: inverse temperature ladder, starting at 1, to train and draw
+    with a ParallelTemperingSampler instead of a GibbsSampler (pcd only)
+    """
+    def __init__(self, lr, batch_size, num_epoch, use_pcd, cd_k, pt_betas=None):
+        assert pt_betas is None or use_pcd, 'parallel tempering needs pcd.'
         self.lr = lr
         self.batch_size = batch_size
         self.num_epoch = num_epoch
         self.use_pcd = use_pcd
         self.cd_k = cd_k
+        self.pt_betas = pt_betas
         self.draw_samples = use_pcd or (cd_k >= 10)
 
     def __str__(self):
-        if self.use_pcd:
+        if self.pt_betas is not None:
+            return 'lr%s_pt%d_pcd%d' % (self.lr, len(self.pt_betas), self.cd_k)
+        elif self.use_pcd:
             return 'lr%s_pcd%d' % (self.lr, self.cd_k)
         else:
             return 'lr%s_cd%d' % (self.lr, self.cd_k)
@@ -45,6 +52,11 @@ class TrainConfig(object):
             _create_and_write_file(log, folder, file_name)
 
 
+def betas_key(betas):
+    """Hashable form of a pt_betas ladder, None stays None."""
+    return None if betas is None else tuple(np.asarray(betas).tolist())
+
+
 def log_train_configs(configs, folder, file_name='train_configs.log'):
     log = ''
     for config in configs: